@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 import os
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+import sys
+import threading
 from pathlib import Path
 
 import click
 
 from behappy.core.conf import settings
 from behappy.core.main import BeHappy, BeHappyFile, BeHappySync
+from behappy.core.server import create_server
 from behappy.core.utils import timeit
 
 
@@ -20,30 +22,72 @@ def main():
 @click.option('--conf', default='behappy.ini', help='Path to config')
 @click.option('--tags', default='', help='Filter albums by tags')
 @click.option('--processes', default='4', type=int, help='Pool size')
+@click.option('--watch', is_flag=True, default=False, help='Rebuild changed albums until interrupted')
+@click.option('--interval', default='1', type=float,
+              help='Seconds between checks of folders if watchdog is not installed, edits in place are found in a minute')
+@click.option('--serve', is_flag=True, default=False, help='Run test web server while watching')
+@click.option('--port', default='8000', help='Port of test web server')
 @timeit
-def build(target, conf, tags, processes):
+def build(target, conf, tags, processes, watch, interval, serve, port):
     """
     Build static site
     """
+    if serve and not watch:
+        raise click.UsageError('--serve works only with --watch, use server command to serve built gallery')
     settings.load(conf)
 
     tags = set([i.strip() for i in tags.split(',') if i.strip()])
     blog = BeHappy(target, tags)
-    blog.build(processes)
+    if not watch:
+        blog.build(processes)
+        return
+    if serve:
+        os.makedirs(target, exist_ok=True)
+        threading.Thread(target=_serve, args=(target, port, settings.header_options()), daemon=True).start()
+    try:
+        blog.watch(processes, interval)
+    except KeyboardInterrupt:
+        print('Stopped')
+
+
+@main.command()
+@click.option('--target', default='target', help='Path to build folder')
+@click.option('--conf', default='behappy.ini', help='Path to config')
+@click.option('--tags', default='', help='Filter albums by tags')
+@click.option('--processes', default='4', type=int, help='Pool size')
+@click.option('--fix', is_flag=True, default=False, help='Copy again videos that differ')
+@timeit
+def verify(target, conf, tags, processes, fix):
+    """
+    Check published videos by full content hash
+    """
+    settings.load(conf)
+
+    tags = set([i.strip() for i in tags.split(',') if i.strip()])
+    blog = BeHappy(target, tags)
+    if blog.verify(processes, fix) and not fix:
+        sys.exit(1)
 
 
 @main.command()
 @click.option('--target', default='target', help='Path to build folder')
 @click.option('--port', default='8000', help='Path to build folder')
-def server(target, port):
+@click.option('--conf', default='behappy.ini', help='Path to config with headers, defaults are used if it is missing')
+def server(target, port, conf):
     """
     Run test web server
     """
     if not os.path.exists(target):
         os.mkdir(target)
-    os.chdir(target)
+    header_options = None
+    if os.path.exists(conf):
+        settings.load(conf)
+        header_options = settings.header_options()
+    _serve(target, port, header_options)
+
 
-    httpd = HTTPServer(('0.0.0.0', int(port)), SimpleHTTPRequestHandler)
+def _serve(target, port, header_options):
+    httpd = create_server(target, int(port), header_options)
     print('# server at http://127.0.0.1:{0}'.format(port))
     httpd.serve_forever()
 
@@ -64,18 +108,25 @@ def new():
 @click.option('--endpoint', default=None, help='S3 endpoint url')
 @click.option('--bucket', help='S3 bucket name')
 @click.option('--cloudfront', default=None, help='AWS cloudfront distribution id')
+@click.option('--threads', default='8', type=int, help='Parallel uploads')
+@click.option('--dry-run', is_flag=True, default=False, help='Only print uploads, deletes and invalidations')
+@click.option('--conf', default='behappy.ini', help='Path to config with headers, defaults are used if it is missing')
 @timeit
-def sync(target, profile, endpoint, bucket, cloudfront):
+def sync(target, profile, endpoint, bucket, cloudfront, threads, dry_run, conf):
     """
     Run test web server
     """
+    header_options = None
+    if os.path.exists(conf):
+        settings.load(conf)
+        header_options = settings.header_options()
     folder = Path(target)
-    be_sync = BeHappySync(folder, profile, endpoint, bucket)
+    be_sync = BeHappySync(folder, profile, endpoint, bucket, threads, header_options)
     print('Sync S3')
-    be_sync.s3()
+    uploaded, deleted = be_sync.s3(dry_run)
     if cloudfront:
         print('Invalidate CloudFront')
-        be_sync.cloudfront_invalidate(cloudfront)
+        be_sync.cloudfront_invalidate(cloudfront, uploaded + deleted, dry_run)
 
 
 if __name__ == '__main__':
@@ -1,69 +1,222 @@
 # -*- coding: utf-8 -*-
 import configparser
 from pathlib import Path
-
-from pytz import timezone
+from types import MappingProxyType
+from typing import NamedTuple, Optional, Dict, Tuple
+
+from pytz import timezone, BaseTzInfo
+
+from behappy.core.headers import HeaderOptions, DEFAULT_HEADERS, available_encodings
+from behappy.core.resize import ResizeOptions
+
+
+class Config(NamedTuple):
+    """
+    Parsed and validated settings, cheap to pickle for pool workers.
+    Dicts are plain to be picklable, `Settings` gives them out as read-only views or copies.
+    """
+    source_folders: Tuple[Path, ...]
+    title: str
+    description: str
+    timezone: BaseTzInfo
+    cache_backend: str
+    cache_dir: Optional[Path]
+    video_fingerprint: str
+    scan_ignore: Tuple[str, ...]
+    page_size: int
+    fsync: bool
+    image_sizes: Dict[str, dict]
+    image_options: Dict[str, ResizeOptions]
+    image_variants: Tuple[ResizeOptions, ...]
+    header_options: Tuple[HeaderOptions, ...]
+    compress_encodings: Tuple[str, ...]
+    about: dict
+    copyright: dict
+    template_extra_html: str
+    templates_parameters: dict
 
 
 class Settings:
 
     def __init__(self):
-        self._conf = None
+        self._config: Optional[Config] = None
+        self._image_sizes = None
+        self._image_options = None
+        self._variant_index = None
 
     def load(self, path):
-        self._conf = configparser.ConfigParser()
-        self._conf.read(path)
+        conf = configparser.ConfigParser()
+        conf.read(path)
+        self.restore(self._parse(conf))
+
+    def snapshot(self):
+        """
+        Loaded state to pass to pool workers
+        """
+        return self._config
+
+    def restore(self, snapshot: Config):
+        self._config = snapshot
+        if snapshot:
+            self._image_sizes = MappingProxyType({k: MappingProxyType(v) for k, v in snapshot.image_sizes.items()})
+            self._image_options = MappingProxyType(snapshot.image_options)
+            self._variant_index = MappingProxyType({v.key: i for i, v in enumerate(snapshot.image_variants)})
+
+    def _parse(self, conf: configparser.ConfigParser):
+        paths = conf.get('gallery', 'source').split(';')
+        cache_dir = conf.get('cache', 'path', fallback='').strip()
+        image_sizes = {}
+        for sec in [i for i in conf.sections() if i.startswith('images:')]:
+            name = sec.replace('images:', '')
+            image_sizes[name] = {
+                'WIDTH': conf.getint(sec, 'width'),
+                'HEIGHT': conf.getint(sec, 'height'),
+                'CROP': conf.getboolean(sec, 'crop', fallback=False),
+                'SPEED': conf.get(sec, 'speed', fallback='balanced').strip(),
+                'FORMATS': [i.strip() for i in conf.get(sec, 'formats', fallback='').split(',') if i.strip()],
+                'WIDTHS': [int(i) for i in conf.get(sec, 'widths', fallback='').split(',') if i.strip()],
+            }
+            for key in ('progressive', 'optimize', 'strip'):
+                if conf.has_option(sec, key):
+                    image_sizes[name][key.upper()] = conf.getboolean(sec, key)
+            if conf.get(sec, 'subsampling', fallback='').strip():
+                image_sizes[name]['SUBSAMPLING'] = conf.get(sec, 'subsampling').strip()
+            if conf.get(sec, 'reencode_above', fallback='').strip():
+                image_sizes[name]['REENCODE_ABOVE'] = conf.getint(sec, 'reencode_above') * 1024
+        headers = {}
+        for sec in [i for i in conf.sections() if i.startswith('headers:')]:
+            name = sec.replace('headers:', '')
+            headers[name] = {
+                'PATTERN': [i.strip() for i in conf.get(sec, 'pattern').split(',') if i.strip()],
+                'CACHE_CONTROL': conf.get(sec, 'cache_control', fallback='').strip(),
+                'ENCODING': conf.get(sec, 'encoding', fallback='').strip(),
+            }
+        compress = [i.strip() for i in conf.get('compress', 'encodings', fallback='').split(',') if i.strip()]
+        if any(i not in HeaderOptions.ENCODINGS for i in compress):
+            raise Exception('Compress ENCODINGS settings have to be of {}'.format(', '.join(HeaderOptions.ENCODINGS)))
+        copyright = {
+            'email': conf.get('copyright', 'email'),
+            'username': conf.get('copyright', 'username'),
+        }
+        extra_html = conf.get('template', 'extra_html', fallback='')
+        image_options = {k: ResizeOptions.from_settings(v, k) for k, v in image_sizes.items()}
+        page_size = conf.getint('gallery', 'page_size', fallback=0)
+        if page_size < 0:
+            raise Exception('Gallery PAGE_SIZE settings have to be not negative')
+        cache_backend = conf.get('cache', 'backend', fallback='json').strip()
+        if cache_backend not in ('json', 'sqlite'):
+            raise Exception('Cache BACKEND settings have to be json or sqlite')
+        return Config(
+            source_folders=tuple(Path(i.strip()) for i in paths if i),
+            title=conf.get('gallery', 'title').strip(),
+            description=conf.get('gallery', 'description').strip(),
+            timezone=timezone(conf.get('gallery', 'timezone', fallback='UTC').strip()),
+            cache_backend=cache_backend,
+            cache_dir=Path(cache_dir) if cache_dir else None,
+            video_fingerprint=conf.get('videos', 'fingerprint', fallback='full').strip(),
+            scan_ignore=tuple(i.strip() for i in conf.get('gallery', 'ignore', fallback='').split(',') if i.strip()),
+            page_size=page_size,
+            fsync=conf.getboolean('gallery', 'fsync', fallback=False),
+            image_sizes=image_sizes,
+            image_options=image_options,
+            image_variants=tuple(j for i in image_options.values() for j in i.variants()),
+            header_options=tuple(HeaderOptions.from_settings(v, k) for k, v in (headers or DEFAULT_HEADERS).items()),
+            compress_encodings=tuple(compress),
+            about={
+                'title': conf.get('about', 'title'),
+                'text': conf.get('about', 'text'),
+            },
+            copyright=copyright,
+            template_extra_html=extra_html,
+            templates_parameters={
+                'copyright': copyright,
+                'EXTRA_HTML': extra_html
+            },
+        )
 
     def source_folders(self):
-        paths = self._conf.get('gallery', 'source').split(';')
-        return [Path(i.strip()) for i in paths if i]
+        return list(self._config.source_folders)
 
     def title(self):
-        return self._conf.get('gallery', 'title').strip()
+        return self._config.title
 
     def description(self):
-        return self._conf.get('gallery', 'description').strip()
+        return self._config.description
 
     def timezone(self):
-        tz = self._conf.get('gallery', 'timezone', fallback='UTC').strip()
-        return timezone(tz)
+        return self._config.timezone
 
-    def image_sizes(self):
-        sec = [i for i in self._conf.sections() if i.startswith('images:')]
-        res = {}
-        for sec in sec:
-            name = sec.replace('images:', '')
-            res[name] = {
-                'WIDTH': self._conf.getint(sec, 'width'),
-                'HEIGHT': self._conf.getint(sec, 'height'),
-                'CROP': self._conf.getboolean(sec, 'crop', fallback=False),
-            }
+    def cache_backend(self):
+        return self._config.cache_backend
+
+    def cache_dir(self):
+        return self._config.cache_dir
 
-        return res
+    def video_fingerprint(self):
+        return self._config.video_fingerprint
+
+    def scan_ignore(self):
+        return list(self._config.scan_ignore)
+
+    def page_size(self):
+        """
+        Default max count of images on album page, 0 - all on one page
+        """
+        return self._config.page_size
+
+    def fsync(self):
+        """
+        Flush written files to disk before they are renamed into place
+        """
+        return self._config.fsync
+
+    def image_sizes(self):
+        return self._image_sizes
 
     def about(self):
-        return {
-            'title': self._conf.get('about', 'title'),
-            'text': self._conf.get('about', 'text'),
-        }
+        return dict(self._config.about)
 
     def copyright(self):
-        return {
-            'email': self._conf.get('copyright', 'email'),
-            'username': self._conf.get('copyright', 'username'),
-        }
+        return dict(self._config.copyright)
 
     def template_extra_html(self):
-        return self._conf.get('template', 'extra_html', fallback='')
+        return self._config.template_extra_html
 
     def image_size(self, name):
-        return self.image_sizes()[name]
+        return self._image_sizes[name]
+
+    def image_options(self):
+        """
+        Precomputed `ResizeOptions` by size name
+        """
+        return self._image_options
+
+    def image_variants(self):
+        """
+        `ResizeOptions` of every rendition file: all sizes with their extra formats and widths
+        """
+        return self._config.image_variants
+
+    def variant_index(self):
+        """
+        Position in `image_variants` by (size name, format, width)
+        """
+        return self._variant_index
+
+    def header_options(self):
+        """
+        `HeaderOptions` in order of sections, defaults if there are no one
+        """
+        return list(self._config.header_options)
+
+    def compress_encodings(self):
+        """
+        Encodings of precompressed sidecars for text files, br is dropped if brotli is not installed
+        """
+        return available_encodings(self._config.compress_encodings)
 
     def templates_parameters(self):
-        return {
-            'copyright': self.copyright(),
-            'EXTRA_HTML': self.template_extra_html()
-        }
+        return dict(self._config.templates_parameters, copyright=self.copyright())
 
 
 settings = Settings()
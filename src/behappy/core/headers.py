@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+import gzip
+import mimetypes
+import os
+from fnmatch import fnmatchcase
+from pathlib import Path, PurePosixPath
+from typing import List, Optional
+
+from behappy.core.utils import atomic_file
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Image formats unknown to older Python versions
+mimetypes.add_type('image/webp', '.webp')
+mimetypes.add_type('image/avif', '.avif')
+
+
+class HeaderOptions(object):
+    """
+    HTTP headers for published files which paths in target folder match one of patterns,
+    such as cache control and content encoding - gzip or br, file is uploaded compressed.
+    """
+    ENCODINGS = ('gzip', 'br')
+
+    def __init__(self, patterns: List[str], cache_control: Optional[str] = None, encoding: Optional[str] = None,
+                 name: str = None):
+        self.patterns = patterns
+        self.cache_control = cache_control if cache_control else None
+        self.encoding = encoding if encoding else None
+        self.name = name if name else None
+        if not self.patterns:
+            raise Exception('Headers PATTERN settings have to be not empty')
+        if self.encoding and self.encoding not in self.ENCODINGS:
+            raise Exception('Headers ENCODING settings have to be one of {}'.format(', '.join(self.ENCODINGS)))
+        if self.encoding == 'br' and brotli is None:
+            raise Exception('Headers ENCODING br needs brotli package')
+
+    @classmethod
+    def from_settings(cls, setting, name=None):
+        return HeaderOptions(
+            patterns=setting['PATTERN'],
+            cache_control=setting.get('CACHE_CONTROL'),
+            encoding=setting.get('ENCODING'),
+            name=name,
+        )
+
+    def match(self, key: str):
+        return any(fnmatchcase(key, i) for i in self.patterns)
+
+    def __repr__(self):
+        return 'HeaderOptions(patterns={p}, cache_control={c}, encoding={e}, name={n})' \
+            .format(p=self.patterns, c=self.cache_control, e=self.encoding, n=self.name)
+
+
+# Renditions and videos are named by content hash and never change
+DEFAULT_HEADERS = {
+    'renditions': {
+        'PATTERN': ['album/*/small/*', 'album/*/big/*', 'album/*/video/*'],
+        'CACHE_CONTROL': 'public, max-age=31536000, immutable',
+    },
+    'pages': {
+        'PATTERN': ['*.html'],
+        'CACHE_CONTROL': 'public, max-age=300',
+        'ENCODING': 'gzip',
+    },
+    'assets': {
+        'PATTERN': ['css/*', 'js/*', '*.txt'],
+        'CACHE_CONTROL': 'public, max-age=86400',
+        'ENCODING': 'gzip',
+    },
+}
+
+
+class HeaderPolicy:
+    """
+    Headers of published files by the first matched `HeaderOptions`
+    """
+
+    def __init__(self, options: List[HeaderOptions]):
+        self.options = options
+
+    def find(self, key: str):
+        return next((i for i in self.options if i.match(key)), None)
+
+    def headers(self, key: str):
+        """
+        Headers as S3 upload arguments
+        """
+        content_type = mimetypes.types_map.get(PurePosixPath(key).suffix, 'application/octet-stream')
+        headers = {'ContentType': content_type}
+        option = self.find(key)
+        if option and option.cache_control:
+            headers['CacheControl'] = option.cache_control
+        if option and option.encoding:
+            headers['ContentEncoding'] = option.encoding
+        return headers
+
+    def encoding(self, key: str):
+        option = self.find(key)
+        return option.encoding if option else None
+
+    @staticmethod
+    def encode(content: bytes, encoding: Optional[str]):
+        """
+        Compress `content` reproducibly, same input gives the same bytes
+        """
+        if encoding == 'gzip':
+            return gzip.compress(content, compresslevel=9, mtime=0)
+        if encoding == 'br':
+            return brotli.compress(content)
+        return content
+
+
+SIDECARS = {'gzip': '.gz', 'br': '.br'}
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+
+
+def available_encodings(encodings: List[str]):
+    """
+    `encodings` without br if brotli package is not installed
+    """
+    return [i for i in encodings if i != 'br' or brotli is not None]
+
+
+def compressible(path: Path):
+    content_type = mimetypes.types_map.get(path.suffix, '')
+    return content_type.startswith(COMPRESSIBLE)
+
+
+def sidecar_path(path: Path, encoding: str):
+    return path.with_name(path.name + SIDECARS[encoding])
+
+
+def sidecar_source(path: Path):
+    """
+    Original file and encoding if `path` is a precompressed sidecar, otherwise None
+    """
+    for encoding, suffix in SIDECARS.items():
+        if path.name.endswith(suffix):
+            return path.with_name(path.name[:-len(suffix)]), encoding
+    return None
+
+
+def fresh_sidecar(path: Path, encoding: str):
+    """
+    Sidecar of `path` if it exists and made from the current file, sidecars get mtime of the original
+    """
+    sidecar = sidecar_path(path, encoding)
+    try:
+        if sidecar.stat().st_mtime_ns == path.stat().st_mtime_ns:
+            return sidecar
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def write_sidecar(path: Path, encoding: str, fsync=False):
+    """
+    Write compressed copy of `path` near it, if it is missing or stale
+    """
+    if fresh_sidecar(path, encoding):
+        return False
+    stat = path.stat()
+    with atomic_file(sidecar_path(path, encoding), fsync) as tmp:
+        tmp.write_bytes(HeaderPolicy.encode(path.read_bytes(), encoding))
+        os.utime(tmp, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    return True
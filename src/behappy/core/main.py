@@ -1,23 +1,37 @@
 # -*- coding: utf-8 -*-
+import collections
 import configparser
+import hashlib
 import importlib.resources
 import io
 import itertools
-import mimetypes
 import re
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import cache
 from multiprocessing.pool import Pool
 from pathlib import Path
+from typing import BinaryIO, List
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+import orjson
 from dateutil.parser import parse
 from jinja2 import Environment, PackageLoader
 
 from behappy.core.conf import settings
+from behappy.core.headers import HeaderOptions, HeaderPolicy, DEFAULT_HEADERS, compressible, fresh_sidecar, \
+    sidecar_source, write_sidecar
 from behappy.core.model import Gallery, ImageSet, VideoSet, Album
-from behappy.core.resize import ResizeOptions, ImageResizer
-from behappy.core.utils import uid, timeit, search_files, CacheManager, all_files
+from behappy.core.resize import ImageResizer, ResizeStats
+from behappy.core.scan import DirectoryScanner
+from behappy.core.utils import uid, timeit, CacheManager, all_files, exiftool, MetadataStore, hasher, \
+    write_if_changed, atomic_write, atomic_file, remove_temp_files, read_exif, TEMP_FILE
+from behappy.core.watch import SourceWatcher
+
+ALBUM_PATTERN = re.compile(r'^behappy\.ini$|^behappy\.\w+\.ini$')
 
 
 def date_filter(value, fmt):
@@ -28,12 +42,150 @@ def linebreaksbr_filter(value):
     return value.replace('\n', '<br/>')
 
 
-def _resize_image(img, cache_path, option):
-    resizer = ImageResizer()
-    r = resizer.resize(img.path, cache_path, option, img.orientation)
-    if r:
-        return 1
-    return 0
+def create_environment():
+    jinja = Environment(
+        loader=PackageLoader('behappy.core'),
+        trim_blocks=True
+    )
+    jinja.filters['date'] = date_filter
+    jinja.filters['linebreaksbr'] = linebreaksbr_filter
+    jinja.globals['now'] = datetime.now()
+    return jinja
+
+
+@cache
+def _worker_environment():
+    return create_environment()
+
+
+def _init_worker(snapshot):
+    settings.restore(snapshot)
+
+
+def _render_page(task):
+    path, template, params = task
+    html = _worker_environment().get_template(template).render(**params, **settings.templates_parameters())
+    atomic_write(path, html.encode('utf-8'), settings.fsync())
+    return path
+
+
+def _compress_file(task):
+    path, encodings = task
+    return sum(write_sidecar(path, i, settings.fsync()) for i in encodings)
+
+
+def _resize_image(task):
+    album_id, img, renditions, describe = task
+    resizer = ImageResizer(fsync=settings.fsync())
+    stats = resizer.resize_all(img.path, renditions, img.orientation)
+    preview = resizer.describe(describe) if describe else None
+    return album_id, stats, img.path.as_posix(), preview
+
+
+class ResizeQueue:
+    """
+    Stream resize tasks of all albums to the pool, keep at most `size` of them
+    in flight and report every album as soon as its last task is done.
+    Placeholders and sizes made by workers are set to the images and saved to album cache.
+    """
+
+    def __init__(self, size: int):
+        self._slots = threading.Semaphore(size)
+        self._stopped = threading.Event()
+        self._albums = {}
+        # Albums without tasks are reported by the consuming thread too, reports are not locked
+        self._empty = collections.deque()
+        self.total = ResizeStats()
+
+    def run(self, pool: Pool, albums):
+        """
+        `albums` - iterable of (album, tasks), tasks are `_resize_image` arguments
+        """
+        try:
+            for album_id, stats, path, preview in pool.imap_unordered(_resize_image, self._feed(albums)):
+                self._slots.release()
+                state = self._albums[album_id]
+                state['done'] += 1
+                state['stats'] += stats
+                if preview:
+                    image = state['images'][path]
+                    image.set_preview(*preview)
+                    state['described'].append(image)
+                if state['done'] == len(state['tasks']):
+                    self._report(album_id)
+                self._report_empty()
+            self._report_empty()
+        finally:
+            self._stopped.set()
+        print('{} resizes, {:.1f} MB written, {:.1f} MB saved by re-encoding originals'.format(
+            self.total.written, self.total.size / 2 ** 20, self.total.saved / 2 ** 20), flush=True)
+
+    def _feed(self, albums):
+        # Runs in the pool task handler thread
+        for album, tasks in albums:
+            images = {i[1].path.as_posix(): i[1] for i in tasks}
+            self._albums[album.id] = dict(album=album, tasks=tasks, images=images, done=0, stats=ResizeStats(),
+                                          described=[])
+            if not tasks:
+                self._empty.append(album.id)
+            for task in tasks:
+                while not self._slots.acquire(timeout=0.1):
+                    if self._stopped.is_set():
+                        return
+                yield task
+
+    def _report_empty(self):
+        while self._empty:
+            self._report(self._empty.popleft())
+
+    def _report(self, album_id):
+        state = self._albums.pop(album_id)
+        if state['described']:
+            state['album'].image_set.save_previews(state['described'])
+        total = sum(len(renditions) for _, _, renditions, _ in state['tasks'])
+        self.total += state['stats']
+        print('[{}] {} of {} resizes'.format(state['album'].title, state['stats'].written, total), flush=True)
+
+
+class PageWriter:
+    """
+    Write rendered page only if its render fingerprint - hash of `salt` and page key - is changed.
+    Fingerprints of pages in `root` are kept in `path` between builds.
+    """
+
+    def __init__(self, root: Path, path: Path, salt, fsync=False):
+        self.root = root
+        self.path = path
+        self.fsync = fsync
+        self.salt = orjson.dumps(salt)
+        self.changed = []
+        self._state = orjson.loads(path.read_bytes()) if path.exists() else {}
+
+    def write(self, path: Path, key, render):
+        """
+        Call `render` and write the result to `path` if `key` or salt is changed
+        """
+        fingerprint = self.fingerprint(key)
+        if self.is_fresh(path, fingerprint):
+            return False
+        atomic_write(path, render().encode('utf-8'), self.fsync)
+        self.written(path, fingerprint)
+        return True
+
+    def fingerprint(self, key):
+        return hashlib.blake2b(self.salt + orjson.dumps(key), digest_size=32).hexdigest()
+
+    def is_fresh(self, path: Path, fingerprint):
+        return self._state.get(path.relative_to(self.root).as_posix()) == fingerprint and path.exists()
+
+    def written(self, path: Path, fingerprint):
+        name = path.relative_to(self.root).as_posix()
+        self._state[name] = fingerprint
+        self.changed.append(name)
+
+    def save(self):
+        if self.changed:
+            atomic_write(self.path, orjson.dumps(self._state))
 
 
 class BeHappyFile:
@@ -80,57 +232,243 @@ class BeHappyFile:
 
 
 class BeHappySync:
-    def __init__(self, folder: Path, profile: str, endpoint: str, bucket: str):
+    """
+    Upload to S3 only files which ETag or size differ from the bucket, delete removed files in batches.
+    Local ETags are kept in `.behappy.sync.json` by file size and mtime, so unchanged files are not read again.
+    Files get headers of `HeaderPolicy`, when only headers are changed objects are copied in place.
+    """
+    MANIFEST = '.behappy.sync.json'
+    # Change when fields of manifest entries are changed, older manifests are discarded
+    MANIFEST_VERSION = 1
+    MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+    MAX_PARTS = 10000
+    DELETE_BATCH = 1000
+    # Folder with more changed paths is invalidated by one wildcard
+    WILDCARD_THRESHOLD = 10
+    # CloudFront limits of one invalidation batch
+    INVALIDATION_PATHS = 3000
+    INVALIDATION_WILDCARDS = 15
+
+    def __init__(self, folder: Path, profile: str, endpoint: str, bucket: str, threads: int = 8,
+                 header_options: List[HeaderOptions] = None):
         self.folder = folder
+        self.bucket = bucket
+        self.threads = threads
+        if header_options is None:
+            header_options = [HeaderOptions.from_settings(v, k) for k, v in DEFAULT_HEADERS.items()]
+        self.policy = HeaderPolicy(header_options)
         self._session = boto3.session.Session(profile_name=profile)
-        self._bucket = self._session.resource('s3', endpoint_url=endpoint).Bucket(name=bucket)
+        # Clients are thread safe unlike resources
+        self._s3 = self._session.client('s3', endpoint_url=endpoint)
         self._cloudfront = self._session.client('cloudfront')
-
-    def s3(self):
-        objects = list(self._bucket.objects.all())
-        files = [i.relative_to(self.folder).as_posix() for i in all_files(self.folder)]
+        self._transfer = TransferConfig(multipart_threshold=self.MULTIPART_CHUNKSIZE,
+                                        multipart_chunksize=self.MULTIPART_CHUNKSIZE, max_concurrency=4)
+        self._manifest_path = Path(folder, self.MANIFEST)
+        self._manifest = {}
+
+    def s3(self, dry_run=False):
+        """
+        Return uploaded and deleted keys, with `dry_run` only print them
+        """
+        objects = self._list_objects()
+        # S3 can not choose encoding by request, sidecars are used only as ready bodies
+        files = {i.relative_to(self.folder).as_posix(): i for i in all_files(self.folder) if not sidecar_source(i)}
         print('Load {} s3 objects and {} local files'.format(len(objects), len(files)))
-
-        # upload new album/*.jpg
-        new_images = set(i for i in files if i.endswith('.jpg') or i.endswith('.mp4')) - \
-                     set(i.key for i in objects if i.key.endswith('.jpg') or i.key.endswith('.mp4'))
-        print('{} images/videos for upload: {}'.format(len(new_images), ','.join(new_images)))
-        for i in new_images:
-            self._s3_upload(i)
-
-        # upload other
-        other = set(i for i in files if not i.endswith('.jpg') and not i.endswith('.mp4'))
-        print('{} files for upload: {}'.format(len(other), ', '.join(other)))
-        for i in other:
-            self._s3_upload(i)
+        self._manifest = self._load_manifest()
+        try:
+            with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                states = executor.map(lambda i: self._local_state(*i), files.items())
+                changed = []
+                retag = []
+                for key, state in zip(files, states):
+                    if objects.get(key) != state:
+                        changed.append(key)
+                    elif self._manifest[key]['headers'] != self.policy.headers(key):
+                        retag.append(key)
+
+                # upload new renditions and videos of album/<id>/<size or video>/ first, pages refer to them
+                media = sorted(i for i in changed if self._is_media(i))
+                print('{} images/videos for upload: {}'.format(len(media), ','.join(media)))
+                if not dry_run:
+                    list(executor.map(self._s3_upload, media))
+
+                # upload other
+                other = sorted(set(changed) - set(media))
+                print('{} files for upload: {}'.format(len(other), ', '.join(other)))
+                if not dry_run:
+                    list(executor.map(self._s3_upload, other))
+
+                # same content with other headers
+                retag.sort()
+                print('{} files for headers update: {}'.format(len(retag), ', '.join(retag)))
+                if not dry_run:
+                    list(executor.map(self._s3_update_headers, retag))
+        finally:
+            self._save_manifest(self._manifest)
 
         # delete removed files
-        for_delete = set(i.key for i in objects) - set(files)
+        for_delete = sorted(set(objects) - set(files))
         print('{} files for delete: {}'.format(len(for_delete), ', '.join(for_delete)))
-        for i in objects:
-            if i.key in for_delete:
-                i.delete()
-
-    def cloudfront_invalidate(self, distribution_id):
-        files = [i.relative_to(self.folder).as_posix() for i in self.folder.glob('**/*.html') if
-                 i.is_file() and not i.name.startswith('.')]
-        print('Find {} html files'.format(len(files)))
-        print('\n'.join(files))
-        self._cloudfront.create_invalidation(
-            DistributionId=distribution_id,
-            InvalidationBatch={
-                'Paths': {
-                    'Quantity': len(files),
-                    'Items': ['/{}'.format(f) for f in files]
-                },
-                'CallerReference': 'my-references-{}'.format(datetime.now())
-            }
-        )
+        failed = []
+        for i in range(0, 0 if dry_run else len(for_delete), self.DELETE_BATCH):
+            batch = for_delete[i:i + self.DELETE_BATCH]
+            response = self._s3.delete_objects(Bucket=self.bucket,
+                                               Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+            # Quiet mode reports only keys that were not deleted
+            failed.extend(response.get('Errors', []))
+        if failed:
+            print('\n'.join('\t{} {} {}'.format(i['Key'], i.get('Code'), i.get('Message')) for i in failed))
+            raise Exception('Cannot delete {} s3 objects'.format(len(failed)))
+        return media + other + retag, for_delete
+
+    @staticmethod
+    def _is_media(key):
+        parts = key.split('/')
+        return len(parts) == 4 and parts[0] == 'album' and parts[2] != 'page'
+
+    def cloudfront_invalidate(self, distribution_id, keys, dry_run=False):
+        """
+        Invalidate paths of changed `keys`, crowded folders are collapsed to wildcards
+        """
+        batches = self._invalidation_batches(self._invalidation_paths(keys))
+        print('{} paths to invalidate in {} batches'.format(sum(len(i) for i in batches), len(batches)))
+        for batch in batches:
+            print('\n'.join('\t{}'.format(i) for i in batch))
+            if dry_run:
+                continue
+            self._cloudfront.create_invalidation(
+                DistributionId=distribution_id,
+                InvalidationBatch={
+                    'Paths': {
+                        'Quantity': len(batch),
+                        'Items': batch
+                    },
+                    'CallerReference': 'behappy-{}'.format(uid())
+                }
+            )
+
+    def _invalidation_paths(self, keys):
+        paths = set()
+        for key in keys:
+            paths.add('/{}'.format(key))
+            # Pages are linked as folders
+            if key == 'index.html' or key.endswith('/index.html'):
+                paths.add('/{}'.format(key[:-len('index.html')]))
+        return self._collapse(sorted(paths), '/')
+
+    def _collapse(self, paths, prefix):
+        """
+        Replace all `paths` in `prefix` folder with one wildcard when it has too many of them, deepest folders first
+        """
+        result = []
+        folders = {}
+        for path in paths:
+            name, sep, _ = path[len(prefix):].partition('/')
+            if sep:
+                folders.setdefault('{}{}/'.format(prefix, name), []).append(path)
+            else:
+                result.append(path)
+        for folder, items in folders.items():
+            result.extend(self._collapse(items, folder))
+        if len(result) > self.WILDCARD_THRESHOLD:
+            return ['{}*'.format(prefix)]
+        return result
+
+    def _invalidation_batches(self, paths):
+        batches = []
+        wildcards = 0
+        for path in paths:
+            wildcard = path.endswith('*')
+            if not batches or len(batches[-1]) == self.INVALIDATION_PATHS or \
+                    (wildcard and wildcards == self.INVALIDATION_WILDCARDS):
+                batches.append([])
+                wildcards = 0
+            batches[-1].append(path)
+            wildcards += wildcard
+        return batches
+
+    def _list_objects(self):
+        """
+        Size and ETag of all objects by key
+        """
+        objects = {}
+        for page in self._s3.get_paginator('list_objects_v2').paginate(Bucket=self.bucket):
+            for i in page.get('Contents', []):
+                objects[i['Key']] = (i['Size'], i['ETag'].strip('"'))
+        return objects
+
+    def _local_state(self, key, file: Path):
+        """
+        Size and ETag that `file` will have in the bucket
+        """
+        stat = file.stat()
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        encoding = self.policy.encoding(key)
+        saved = self._manifest.get(key)
+        if saved and saved['stamp'] == stamp and saved['encoding'] == encoding:
+            return saved['size'], saved['etag']
+        if encoding:
+            body = self._body(file, encoding)
+            size, etag = len(body), self._etag(io.BytesIO(body), len(body))
+        else:
+            with file.open('rb') as f:
+                size, etag = stat.st_size, self._etag(f, stat.st_size)
+        # Headers are known only after upload
+        headers = saved['headers'] if saved else None
+        self._manifest[key] = dict(stamp=stamp, encoding=encoding, size=size, etag=etag, headers=headers)
+        return size, etag
+
+    def _etag(self, f: BinaryIO, size: int):
+        """
+        MD5 of content, for multipart upload MD5 of parts digests with count of parts, same as S3 does
+        """
+        chunksize = self.MULTIPART_CHUNKSIZE
+        while size > chunksize * self.MAX_PARTS:
+            chunksize *= 2
+        digests = []
+        while chunk := f.read(chunksize):
+            digests.append(hashlib.md5(chunk).digest())
+        if size < self.MULTIPART_CHUNKSIZE:
+            return digests[0].hex() if digests else hashlib.md5().hexdigest()
+        return '{}-{}'.format(hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
+
+    def _load_manifest(self):
+        if self._manifest_path.exists():
+            state = orjson.loads(self._manifest_path.read_bytes())
+            if state.get('version') == self.MANIFEST_VERSION and state.get('chunksize') == self.MULTIPART_CHUNKSIZE:
+                return state['files']
+        return {}
+
+    def _save_manifest(self, manifest):
+        content = orjson.dumps({'version': self.MANIFEST_VERSION, 'chunksize': self.MULTIPART_CHUNKSIZE,
+                                'files': manifest})
+        write_if_changed(self._manifest_path, content)
 
     def _s3_upload(self, key):
         file = Path(self.folder, key)
-        content_type = mimetypes.types_map.get(file.suffix, 'application/octet-stream')
-        self._bucket.upload_file(file.as_posix(), key, ExtraArgs={'ContentType': content_type})
+        headers = self.policy.headers(key)
+        encoding = headers.get('ContentEncoding')
+        if encoding:
+            body = self._body(file, encoding)
+            self._s3.upload_fileobj(io.BytesIO(body), self.bucket, key, ExtraArgs=headers, Config=self._transfer)
+        else:
+            self._s3.upload_file(file.as_posix(), self.bucket, key, ExtraArgs=headers, Config=self._transfer)
+        self._manifest[key]['headers'] = headers
+
+    def _body(self, file: Path, encoding: str):
+        """
+        Compressed content of `file`, from its sidecar if it is fresh
+        """
+        sidecar = fresh_sidecar(file, encoding)
+        if sidecar:
+            return sidecar.read_bytes()
+        return self.policy.encode(file.read_bytes(), encoding)
+
+    def _s3_update_headers(self, key):
+        headers = self.policy.headers(key)
+        self._s3.copy({'Bucket': self.bucket, 'Key': key}, self.bucket, key,
+                      ExtraArgs=dict(headers, MetadataDirective='REPLACE'), Config=self._transfer)
+        self._manifest[key]['headers'] = headers
 
 
 class BeHappy:
@@ -138,36 +476,93 @@ class BeHappy:
         self.gallery = Gallery(settings.title(), settings.description())
         self.target = target
         self.tags = tags
-        self.jinja = Environment(
-            loader=PackageLoader('behappy.core'),
-            trim_blocks=True
-        )
-        self.jinja.filters['date'] = date_filter
-        self.jinja.filters['linebreaksbr'] = linebreaksbr_filter
-        self.jinja.globals['now'] = datetime.now()
+        self.cache_dir = settings.cache_dir() or Path(target)
+        self.store = None
+        if settings.cache_backend() == 'sqlite':
+            self.store = MetadataStore(Path(self.cache_dir, '.behappy.sqlite'))
+        self.jinja = create_environment()
+        self.pages = PageWriter(Path(target), Path(self.cache_dir, '.behappy.pages.json'), self._render_salt(),
+                                settings.fsync())
+        # Metadata caches are written near the albums by the build itself, they are not sources
+        self.scanner = DirectoryScanner(Path(self.cache_dir, '.behappy.scan.json'),
+                                        settings.scan_ignore() + ['*.cache.json'])
+        # Loaded album ini files with their stamps, to find edited ones in watch mode
+        self.sources = {}
 
     def build(self, processes: int):
         print('Starting')
-        self._load_albums()
-        self._resize_images(processes)
-        self._copy_video()
+        try:
+            self._load(processes)
+            with Pool(processes=processes, initializer=_init_worker, initargs=(settings.snapshot(),)) as pool:
+                self._publish(pool, processes, self.gallery.albums())
+        finally:
+            self._close_store()
+        print('Done!')
+
+    def watch(self, processes: int, interval: float):
+        """
+        Build and keep the gallery in memory. On every change of sources reload only affected albums,
+        resize their new images and render again only pages that depend on them.
+        """
+        print('Starting')
+        watcher = SourceWatcher(settings.source_folders(), interval)
+        watcher.start()
+        try:
+            self._load(processes)
+            with Pool(processes=processes, initializer=_init_worker, initargs=(settings.snapshot(),)) as pool:
+                self._publish(pool, processes, self.gallery.albums())
+                print('Watching for changes ({})'.format(watcher.backend), flush=True)
+                while True:
+                    paths = watcher.wait()
+                    try:
+                        albums = self._reload(processes, paths)
+                        if albums:
+                            self._publish(pool, processes, albums)
+                            print('Done!', flush=True)
+                    except Exception as e:
+                        # Keep watching, sources are probably in the middle of editing
+                        print('Error: {}'.format(e), flush=True)
+        finally:
+            watcher.close()
+            self._close_store()
+
+    def _publish(self, pool: Pool, processes: int, albums):
+        """
+        Resize, copy and render everything for `albums`, gallery wide pages are written only if changed
+        """
+        self._resize_images(pool, processes, albums)
+        self._copy_video(albums)
         self._copy_static_resources()
         self._write_robots()
         self._render_about_page()
         self._render_index_page()
         self._render_year_pages()
-        self._render_album_pages()
+        self._render_album_pages(pool, albums)
         self._render_error_page(name='404', title='404', message='Page not found')
-        print('Done!')
+        self._compress_files(pool)
+        self.pages.save()
+        print('{} pages changed'.format(len(self.pages.changed)))
+        for path in self.pages.changed:
+            print('\t{}'.format(path))
+        self.pages.changed.clear()
+
+    def _render_salt(self):
+        """
+        Everything that affects all pages: templates, settings and current year
+        """
+        loader = self.jinja.loader
+        templates = [loader.get_source(self.jinja, i)[0] for i in loader.list_templates() if i.endswith('.jinja2')]
+        image_sizes = {k: dict(v) for k, v in settings.image_sizes().items()}
+        return [templates, settings.templates_parameters(), image_sizes,
+                self.gallery.title, self.gallery.description, self.jinja.globals['now'].year]
 
     @timeit
     def _render_about_page(self):
-        html = self.jinja.get_template('about.jinja2').render(**settings.templates_parameters(),
-                                                              **settings.about())
-        folder = Path(self.target, 'about')
-        folder.mkdir(parents=True, exist_ok=True)
-        with Path(folder, 'index.html').open(mode='w') as f:
-            f.write(html)
+        def render():
+            return self.jinja.get_template('about.jinja2').render(**settings.templates_parameters(),
+                                                                  **settings.about())
+
+        self.pages.write(Path(self.target, 'about', 'index.html'), settings.about(), render)
 
     @timeit
     def _render_index_page(self):
@@ -176,10 +571,13 @@ class BeHappy:
                       description=self.gallery.description,
                       albums=self.gallery.top_albums(),
                       years=self.gallery.top_years())
-        html = self.jinja.get_template('gallery.jinja2').render(**params,
-                                                                **settings.templates_parameters())
-        with Path(self.target, 'index.html').open(mode='w') as f:
-            f.write(html)
+        key = [[i.render_key() for i in params['albums']], params['years']]
+
+        def render():
+            return self.jinja.get_template('gallery.jinja2').render(**params,
+                                                                    **settings.templates_parameters())
+
+        self.pages.write(Path(self.target, 'index.html'), key, render)
 
     @timeit
     def _render_year_pages(self):
@@ -193,85 +591,245 @@ class BeHappy:
                           albums=albums,
                           years=self.gallery.top_years(),
                           current_year=year)
-            html = self.jinja.get_template('gallery.jinja2').render(**params,
-                                                                    **settings.templates_parameters())
-            folder = Path(self.target, 'year', str(year))
-            folder.mkdir(parents=True, exist_ok=True)
-            with Path(folder, 'index.html').open(mode='w') as f:
-                f.write(html)
+            key = [[i.render_key() for i in albums], params['years'], year]
+
+            def render(params=params):
+                return self.jinja.get_template('gallery.jinja2').render(**params,
+                                                                        **settings.templates_parameters())
+
+            self.pages.write(Path(self.target, 'year', str(year), 'index.html'), key, render)
 
     @timeit
-    def _render_album_pages(self):
-        gallery_template = self.jinja.get_template('gallery.jinja2')
-        album_template = self.jinja.get_template('album.jinja2')
-        for album in self.gallery.albums():
+    def _render_album_pages(self, pool: Pool, albums):
+        fingerprints = {}
+        tasks = []
+        for album in albums:
             if album.children:
-                albums = sorted(album.children, key=lambda x: x.date)
+                children = sorted(album.children, key=lambda x: x.date)
                 params = dict(title=album.title,
                               html_title=album.title,
                               description=album.description,
-                              albums=albums,
+                              albums=children,
                               back=dict(id=album.parent))
-                html = gallery_template.render(**params,
-                                               **settings.templates_parameters())
+                key = [album.render_key(), [i.render_key() for i in children]]
+                pages = [(Path(self.target, 'album', str(album.id), 'index.html'), params, key)]
+                template = 'gallery.jinja2'
             else:
-                params = dict(album=album,
-                              images=album.image_set.images(),
-                              videos=album.video_set.videos(),
-                              back=dict(id=album.parent))
-                html = album_template.render(**params,
-                                             **settings.templates_parameters())
-            with Path(self.target, 'album', str(album.id), 'index.html').open(mode='w') as f:
-                f.write(html)
+                pages = self._album_pages(album)
+                template = 'album.jinja2'
+
+            for path, params, key in pages:
+                fingerprint = self.pages.fingerprint(key)
+                if not self.pages.is_fresh(path, fingerprint):
+                    fingerprints[path] = fingerprint
+                    tasks.append((path, template, params))
+
+        for path in pool.imap_unordered(_render_page, tasks):
+            self.pages.written(path, fingerprints[path])
+
+    def _album_pages(self, album):
+        """
+        Path, template parameters and render key of every page of album, videos are on the first one.
+        Pages left from previous builds with more pages are removed.
+        """
+        images = album.image_set.images()
+        videos = album.video_set.videos()
+        chunks = album.pages(images)
+        result = []
+        for number, chunk in enumerate(chunks, start=1):
+            page = dict(number=number, count=len(chunks),
+                        previous=album.page_uri(number - 1) if number > 1 else None,
+                        next=album.page_uri(number + 1) if number < len(chunks) else None)
+            params = dict(album=album,
+                          images=chunk,
+                          videos=videos if number == 1 else [],
+                          images_count=len(images),
+                          page=page,
+                          back=dict(id=album.parent))
+            key = [album.render_key(), page, len(images),
+                   [i.render_key() for i in params['images']],
+                   [i.render_key() for i in params['videos']]]
+            path = Path(self.target, Path(album.page_uri(number)).relative_to('/'), 'index.html')
+            result.append((path, params, key))
+
+        folder = Path(self.target, 'album', str(album.id), 'page')
+        if folder.exists():
+            for i in folder.iterdir():
+                if i.is_dir() and not (i.name.isdigit() and 1 < int(i.name) <= len(chunks)):
+                    shutil.rmtree(i.as_posix())
+            if not any(folder.iterdir()):
+                folder.rmdir()
+        return result
 
     @timeit
     def _render_error_page(self, name, title, message):
-        html = self.jinja.get_template('message.jinja2').render(title=title, message=message,
-                                                                **settings.templates_parameters())
-        folder = Path(self.target, 'error')
-        folder.mkdir(parents=True, exist_ok=True)
-        with Path(folder, '{}.html'.format(name)).open(mode='w') as f:
-            f.write(html)
+        def render():
+            return self.jinja.get_template('message.jinja2').render(title=title, message=message,
+                                                                    **settings.templates_parameters())
+
+        self.pages.write(Path(self.target, 'error', '{}.html'.format(name)), [title, message], render)
 
     @timeit
     def _copy_static_resources(self):
         for t in ('css', 'img', 'js'):
             path = Path(self.target, t)
-            shutil.rmtree(path, ignore_errors=True)
-            path.mkdir()
+            path.mkdir(exist_ok=True)
             module = f'behappy.core.templates.{t}'
-            for name in importlib.resources.contents(module):
+            names = set(importlib.resources.contents(module))
+            for file in path.iterdir():
+                if file.name not in names and not sidecar_source(file):
+                    file.unlink()
+            for name in names:
                 content = importlib.resources.read_binary(module, name)
-                Path(path, name).write_bytes(content)
+                write_if_changed(Path(path, name), content, settings.fsync())
 
     @timeit
-    def _write_robots(self):
-        with Path(self.target, 'robots.txt').open(mode='w') as f:
-            f.writelines([
-                'User-agent: *\n',
-                'Disallow: /\n',
-            ])
+    def _compress_files(self, pool: Pool):
+        """
+        Write sidecars of changed text files and remove sidecars of removed or not compressed ones
+        """
+        encodings = settings.compress_encodings()
+        tasks = []
+        removed = 0
+        for file in self._text_files():
+            source = sidecar_source(file)
+            if source:
+                if source[1] not in encodings or not source[0].exists():
+                    file.unlink()
+                    removed += 1
+            elif compressible(file) and any(not fresh_sidecar(file, i) for i in encodings):
+                tasks.append((file, encodings))
+        written = sum(pool.imap_unordered(_compress_file, tasks))
+        print('{} sidecars written, {} removed'.format(written, removed))
+
+    def _text_files(self):
+        """
+        Files of folders with pages and static resources, renditions and videos are not walked
+        """
+        target = Path(self.target)
+        files = [i for i in target.iterdir() if i.is_file() and not i.name.startswith('.')]
+        for name in ('about', 'css', 'error', 'img', 'js', 'year'):
+            files.extend(all_files(Path(target, name)))
+        albums = Path(target, 'album')
+        for folder in albums.iterdir() if albums.is_dir() else []:
+            files.extend(i for i in folder.iterdir() if i.is_file() and not i.name.startswith('.'))
+            files.extend(all_files(Path(folder, 'page')))
+        return files
 
     @timeit
-    def _resize_images(self, processes: int):
-        with Pool(processes=processes) as pool:
-            for album in self.gallery.albums():
-                path = Path(self.target, 'album', str(album.id))
-                path.mkdir(parents=True, exist_ok=True)
-                tasks = []
-                for image in itertools.chain(album.image_set.images(), [album.image_set.thumbnail]):
-                    if image:
-                        for name, size in settings.image_sizes().items():
-                            option = ResizeOptions.from_settings(size, name)
-                            cache_path = image.cache_path(self.target, album.id, option)
-                            tasks.append((image, cache_path, option,))
-                result = pool.starmap(_resize_image, tasks)
-
-                print('[{}] {} of {} resizes'.format(album.title, sum(result), len(result)), flush=True)
+    def _write_robots(self):
+        write_if_changed(Path(self.target, 'robots.txt'), b'User-agent: *\nDisallow: /\n', settings.fsync())
 
     @timeit
-    def _copy_video(self):
+    def _resize_images(self, pool: Pool, processes: int, albums):
+        queue = ResizeQueue(size=processes * 4)
+        queue.run(pool, ((i, self._resize_tasks(i)) for i in albums))
+
+    def _resize_tasks(self, album):
+        path = Path(self.target, 'album', str(album.id))
+        path.mkdir(parents=True, exist_ok=True)
+        images = album.image_set.images()
+        thumbnail = album.image_set.thumbnail
+        if thumbnail and all(i.path != thumbnail.path for i in images):
+            images = itertools.chain(images, [thumbnail])
+        tasks = []
+        for image in images:
+            renditions = []
+            for option in settings.image_variants():
+                cache_path = image.cache_path(self.target, album.id, option)
+                renditions.append((cache_path, option,))
+            describe = []
+            if image.need_preview():
+                describe = [image.cache_path(self.target, album.id, i) for i in settings.image_options().values()]
+            tasks.append((album.id, image, renditions, describe,))
+        return tasks
+
+    def verify(self, processes: int, fix: bool):
+        """
+        Compare full content hash of every video with its published copy.
+        Needed for sampled fingerprints, that do not see changes in the middle of file.
+        Return count of broken copies.
+        """
+        try:
+            self._load(processes)
+        finally:
+            self._close_store()
+        broken = 0
         for album in self.gallery.albums():
+            for video in album.video_set.videos():
+                cache_path = video.cache_path(self.target, album.id)
+                if cache_path.exists():
+                    source, copy = [i.result() for i in hasher.submit([video.path, cache_path])]
+                    if source == copy:
+                        continue
+                broken += 1
+                print('[{}] {} is not equal to {}'.format(album.title, cache_path, video.path), flush=True)
+                if fix:
+                    with atomic_file(cache_path, settings.fsync()) as tmp:
+                        shutil.copy(video.path, tmp)
+                        tmp.chmod(0o644)
+        hasher.close()
+        print(hasher.report(), flush=True)
+        return broken
+
+    def _load(self, processes: int):
+        exiftool.configure(processes)
+        hasher.configure(processes)
+        try:
+            self._load_albums(processes)
+        finally:
+            exiftool.close()
+            hasher.close()
+
+    def _close_store(self):
+        if self.store:
+            self.store.close()
+
+    def _reload(self, processes: int, paths):
+        """
+        Load again albums which ini files or folders with `paths` are changed.
+        Return albums to publish: reloaded ones and their parents.
+        """
+        changed = [i.absolute() for i in itertools.chain(paths, self.scanner.rescan(settings.source_folders()))]
+        inis = set(self.scanner.search(ALBUM_PATTERN)) | set(self.sources)
+        stale = []
+        for ini in inis:
+            stamp, _ = self.sources.get(ini, (None, None))
+            folder = ini.parent.absolute()
+            if stamp != self._source_stamp(ini) or any(folder == i or folder in i.parents for i in changed):
+                stale.append(ini)
+        if not stale:
+            return []
+        affected = set()
+        for ini in stale:
+            _, album = self.sources.pop(ini, (None, None))
+            if album:
+                self.gallery.remove_album(album)
+                affected.add(album.parent)
+        exiftool.configure(processes)
+        hasher.configure(processes)
+        read_exif.cache.clear()
+        try:
+            albums = self._add_albums([i for i in stale if i.exists()])
+            with ThreadPoolExecutor(max_workers=processes) as executor:
+                list(executor.map(self._load_album_media, albums))
+        finally:
+            exiftool.close()
+            hasher.close()
+        affected.update(i.id for i in albums)
+        affected.update(i.parent for i in albums)
+        return [i for i in self.gallery.albums() if i.id in affected]
+
+    def _source_stamp(self, ini: Path):
+        try:
+            stat = ini.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    @timeit
+    def _copy_video(self, albums):
+        for album in albums:
             total = 0
             copied = 0
             path = Path(self.target, 'album', str(album.id))
@@ -282,52 +840,101 @@ class BeHappy:
                 cache_path = video.cache_path(self.target, album.id)
                 if not cache_path.exists():
                     copied += 1
-                    shutil.copy(video.path, cache_path)
-                    cache_path.chmod(0o644)
+                    with atomic_file(cache_path, settings.fsync()) as tmp:
+                        shutil.copy(video.path, tmp)
+                        tmp.chmod(0o644)
 
             print('[{}] {} of {} copied videos'.format(album.title, copied, total), flush=True)
 
-    @timeit
-    def _load_albums(self):
-        pattern = re.compile(r'^behappy\.ini$|^behappy\.\w+\.ini$')
-        inis = search_files(settings.source_folders(), pattern)
+    def _add_albums(self, inis):
+        """
+        Read albums from `inis` and add them to the gallery, return added ones
+        """
+        albums = []
         for ini in inis:
-            conf = configparser.ConfigParser()
-            conf.read(ini)
-            title = conf.get('album', 'title')
-            cache_manager = CacheManager(ini, title)
-            image_set = ImageSet(
-                path=ini.parent,
-                thumbnail=conf.get('images', 'thumbnail'),
-                include=conf.get('images', 'include', fallback=None),
-                exclude=conf.get('images', 'exclude', fallback=None),
-                sortby=conf.get('images', 'sortby', fallback='date'),
-                cache_manager=cache_manager
-            )
-            video_set = VideoSet(
-                path=ini.parent,
-                include=conf.get('videos', 'include', fallback=None),
-                exclude=conf.get('videos', 'exclude', fallback=None),
-                sortby=conf.get('videos', 'sortby', fallback='date'),
-                cache_manager=cache_manager
-            )
-            album = Album(
-                id=conf.get('album', 'id'),
-                parent=conf.get('album', 'parent', fallback=None),
-                title=title,
-                description=conf.get('album', 'description'),
-                date=conf.get('album', 'date'),
-                tags=conf.get('album', 'tags', fallback=''),
-                hidden=conf.getboolean('album', 'hidden', fallback=False),
-                path=ini.parent,
-                image_set=image_set,
-                video_set=video_set
-            )
-            if not self.tags or any(i in album.tags for i in self.tags):
+            # Broken ini is not read again until it is changed
+            self.sources[ini] = (self._source_stamp(ini), None)
+            album = self._read_album(ini)
+            self.sources[ini] = (self.sources[ini][0], album)
+            if album:
                 self.gallery.add_album(album)
+                albums.append(album)
         for album in self.gallery.albums():
             album.children = [i for i in self.gallery.albums() if album.id == i.parent]
+        return albums
+
+    def _read_album(self, ini: Path):
+        """
+        Album from `ini` file, None if it is filtered out by tags
+        """
+        conf = configparser.ConfigParser()
+        conf.read(ini)
+        title = conf.get('album', 'title')
+        cache_manager = self.store.manager(ini, title) if self.store else CacheManager(ini, title)
+        image_set = ImageSet(
+            path=ini.parent,
+            thumbnail=conf.get('images', 'thumbnail'),
+            include=conf.get('images', 'include', fallback=None),
+            exclude=conf.get('images', 'exclude', fallback=None),
+            sortby=conf.get('images', 'sortby', fallback='date'),
+            cache_manager=cache_manager,
+            scanner=self.scanner
+        )
+        video_set = VideoSet(
+            path=ini.parent,
+            include=conf.get('videos', 'include', fallback=None),
+            exclude=conf.get('videos', 'exclude', fallback=None),
+            sortby=conf.get('videos', 'sortby', fallback='date'),
+            cache_manager=cache_manager,
+            fingerprint=conf.get('videos', 'fingerprint', fallback=settings.video_fingerprint()).strip(),
+            scanner=self.scanner
+        )
+        album = Album(
+            id=conf.get('album', 'id'),
+            parent=conf.get('album', 'parent', fallback=None),
+            title=title,
+            description=conf.get('album', 'description'),
+            date=conf.get('album', 'date'),
+            tags=conf.get('album', 'tags', fallback=''),
+            hidden=conf.getboolean('album', 'hidden', fallback=False),
+            path=ini.parent,
+            image_set=image_set,
+            video_set=video_set,
+            page_size=conf.getint('album', 'page_size', fallback=settings.page_size())
+        )
+        if not self.tags or any(i in album.tags for i in self.tags):
+            return album
+        return None
+
+    def _load_album_media(self, album):
+        album.image_set.images()
+        album.image_set.thumbnail
+        album.video_set.videos()
+
+    def _output_folders(self):
+        """
+        Folders that are written by the build: cache, pages, static resources, renditions and videos
+        """
+        target = Path(self.target)
+        patterns = ('about', 'css', 'error', 'img', 'js', 'year/*', 'album/*', 'album/*/*', 'album/*/page/*')
+        return [target, Path(self.cache_dir)] + [i for p in patterns for i in target.glob(p) if i.is_dir()]
 
+    @timeit
+    def _load_albums(self, processes: int):
+        scanner = self.scanner
+        scanner.scan(settings.source_folders())
+        scanner.save()
+        print('Scan {} folders, {} of them changed'.format(scanner.listed + scanner.reused, scanner.listed))
+        # Partial files of interrupted build, completed ones are reused. Metadata caches near albums are found in listings
+        removed = remove_temp_files(self._output_folders() + [i.parent for i in scanner.search(TEMP_FILE)])
+        if removed:
+            print('Removed {} temporary files of interrupted build'.format(removed), flush=True)
+        self._add_albums(scanner.search(ALBUM_PATTERN))
+
+        with ThreadPoolExecutor(max_workers=processes) as executor:
+            list(executor.map(self._load_album_media, self.gallery.albums()))
+
+        print(hasher.report(), flush=True)
         albums_count = len(self.gallery.albums())
         image_count = sum(i.image_set.images_count() for i in self.gallery.albums())
         print('Load {} albums and {} images'.format(albums_count, image_count), flush=True)
@@ -1,13 +1,16 @@
 # -*- coding: utf-8 -*-
 import hashlib
+import logging
 from datetime import datetime
-from functools import cache, cached_property
 from pathlib import Path
 from typing import List
 
 from behappy.core.conf import settings
 from behappy.core.resize import ResizeOptions
-from behappy.core.utils import read_exif, file_stamp, CacheManager, Exif
+from behappy.core.scan import DirectoryScanner
+from behappy.core.utils import read_exif, file_stamp, CacheManager, Exif, hasher
+
+logger = logging.getLogger(__name__)
 
 
 class Gallery:
@@ -27,6 +30,11 @@ class Gallery:
             msg = 'Gallery already have album "{}" with id {}\n{}\n{}'
             raise Exception(msg.format(title, album.id, path, album.path))
 
+    def remove_album(self, album):
+        if self._ids.get(album.id) is album:
+            self._albums.remove(album)
+            del self._ids[album.id]
+
     def albums(self):
         return sorted(self._albums, key=lambda x: x.date, reverse=True)
 
@@ -40,40 +48,142 @@ class Gallery:
         return sorted([i for i in self._albums if not i.parent and i.hidden], key=lambda x: x.date, reverse=True)
 
 
-class Image:
+def _slots_state(obj):
+    return {i: getattr(obj, i, None) for cls in type(obj).__mro__ for i in getattr(cls, '__slots__', ())}
+
+
+def _set_slots_state(obj, state):
+    for key, value in state.items():
+        object.__setattr__(obj, key, value)
+
+
+class MediaFile:
+    """
+    Compact base of images and videos for very large galleries:
+    path is kept as shared album folder and file name, digests as bytes.
+    """
+    __slots__ = ('_root', '_name', 'date', 'exif_info', '_stamp', '_hash', '_id')
+    _roots = {}
+
+    def __init__(self, path: Path, date, exif_info, stamp, hash):
+        self._root = self._roots.setdefault(path.parent.as_posix(), path.parent)
+        self._name = path.name
+        self.date = date
+        self.exif_info = exif_info
+        self.stamp = stamp
+        self.hash = hash
+        self._id = None
+
+    @property
+    def path(self):
+        return Path(self._root, self._name)
+
+    @property
+    def stamp(self):
+        return self._stamp.hex() if self._stamp is not None else None
+
+    @stamp.setter
+    def stamp(self, value):
+        self._stamp = bytes.fromhex(value) if value is not None else None
+
+    @property
+    def hash(self):
+        return self._hash.hex() if self._hash is not None else None
+
+    @hash.setter
+    def hash(self, value):
+        self._hash = bytes.fromhex(value) if value is not None else None
+
+    @property
+    def id(self):
+        if self._id is None:
+            self._id = self._digest_for(self.path.as_posix())
+        return self._id.hex()
+
+    def _hash_for(self, content):
+        return self._digest_for(content).hex()
+
+    def _digest_for(self, content):
+        return hashlib.blake2b(bytes(content, encoding='utf-8'), digest_size=32).digest()
+
+    def __getstate__(self):
+        return _slots_state(self)
+
+    def __setstate__(self, state):
+        _set_slots_state(self, state)
+
+    def __repr__(self):
+        return str(_slots_state(self))
+
+
+class Image(MediaFile):
     VERSION = 1
+    __slots__ = ('orientation', 'placeholder', '_dimensions', '_renditions')
 
     def __init__(self, path: Path, exif: Exif = None,
-                 date=None, orientation=None, exif_info=None, stamp=None, hash=None):
-        self.path = path
+                 date=None, orientation=None, exif_info=None, stamp=None, hash=None, placeholder=None,
+                 dimensions=None):
         if exif:
-            self.date = exif.datetime_original
+            super().__init__(path, exif.datetime_original, exif.info(), file_stamp(self.VERSION, path),
+                             hash or hasher.hash(path))
             self.orientation = exif.orientation
-            self.exif_info = exif.info()
-            self.stamp = file_stamp(self.VERSION, self.path)
-            self.hash = hashlib.blake2b(self.path.read_bytes()).hexdigest()
         else:
-            self.date = date
+            super().__init__(path, date, exif_info, stamp, hash)
             self.orientation = orientation
-            self.exif_info = exif_info
-            self.stamp = stamp
-            self.hash = hash
+        # Data URI of tiny preview and real sizes of renditions by cache name, made by resize worker
+        self.placeholder = placeholder
+        self._dimensions = dimensions if dimensions else {}
+        self._renditions = None
+
+    def rendition(self, key):
+        """
+        Cache name of image variant by (size name, format, width), all names are computed once per build
+        """
+        if self._renditions is None:
+            self._renditions = tuple(bytes.fromhex(self._cache_name(i)) for i in settings.image_variants())
+        return self._renditions[settings.variant_index()[key]].hex()
+
+    def uri(self, album_id, size_name, fmt='jpeg', width=None):
+        option = settings.image_options()[size_name]
+        name = self.rendition((size_name, fmt, width or option.width))
+        return Path('/album/{}/{}/{}.{}'.format(album_id, size_name, name, ResizeOptions.FORMATS[fmt][1]))
+
+    def sources(self, album_id, size_name):
+        """
+        Type and srcset for every format of size, empty if it has no extra formats or widths
+        """
+        option = settings.image_options()[size_name]
+        if not option.formats and not option.widths:
+            return []
+        sources = []
+        for fmt in (*option.formats, option.format):
+            srcset = ', '.join('{} {}w'.format(self.uri(album_id, size_name, fmt, i), i)
+                               for i in (*option.widths, option.width))
+            sources.append(dict(type=ResizeOptions.FORMATS[fmt][2], srcset=srcset))
+        return sources
 
-    @property
-    def id(self):
-        return self._hash_for(self.path.as_posix())
+    def size_for(self, size_name):
+        s = settings.image_options()[size_name]
+        return self.dimensions(size_name) or dict(width=s.width, height=s.height)
 
-    def uri(self, album_id, size_name):
-        size_options = ResizeOptions.from_settings(settings.image_size(size_name), size_name)
-        cache_name = self._cache_name(size_options)
-        return Path('/album/{}/{}/{}.jpg'.format(album_id, size_options.name, cache_name))
+    def dimensions(self, size_name):
+        """
+        Real width and height of rendition, None if it is not known yet
+        """
+        size = self._dimensions.get(self.rendition(settings.image_options()[size_name].key))
+        return dict(width=size[0], height=size[1]) if size else None
 
-    def size_for(self, size_name):
-        s = settings.image_size(size_name)
-        return dict(width=s['WIDTH'], height=s['HEIGHT'])
+    def need_preview(self):
+        names = [self.rendition(i.key) for i in settings.image_options().values()]
+        return self.placeholder is None or any(i not in self._dimensions for i in names)
+
+    def set_preview(self, placeholder, dimensions):
+        self.placeholder = placeholder
+        self._dimensions = {k: list(v) for k, v in dimensions.items()}
 
     def cache_path(self, target, album_id, size_options):
-        return Path(target, Path(self.uri(album_id, size_options.name)).relative_to('/'))
+        uri = self.uri(album_id, size_options.name, size_options.format, size_options.width)
+        return Path(target, uri.relative_to('/'))
 
     def _cache_name(self, size_options):
         option_pack = tuple()
@@ -81,10 +191,17 @@ class Image:
         option_pack += (size_options.name, self.hash,)
         if self.orientation:
             option_pack += ('orientation', self.orientation,)
+        if size_options.format != 'jpeg':
+            option_pack += ('format', size_options.format,)
+        if size_options.encoder:
+            option_pack += ('encoder', size_options.encoder,)
         return self._hash_for(str(option_pack))
 
-    def _hash_for(self, content):
-        return hashlib.blake2b(bytes(content, encoding='utf-8'), digest_size=32).hexdigest()
+    def render_key(self):
+        """
+        Fields that are used by templates
+        """
+        return [self.path.as_posix(), self.hash, self.orientation, self.exif_info, self.placeholder, self._dimensions]
 
     def serialize(self):
         return {'path': self.path.absolute().as_posix(),
@@ -92,7 +209,9 @@ class Image:
                 'orientation': self.orientation,
                 'exif_info': self.exif_info,
                 'stamp': self.stamp,
-                'hash': self.hash, }
+                'hash': self.hash,
+                'placeholder': self.placeholder,
+                'dimensions': self._dimensions, }
 
     @classmethod
     def make_stamp(cls, source: Path):
@@ -101,40 +220,34 @@ class Image:
     @classmethod
     def deserialize(cls, source):
         path = source['path']
-        date = source['date']
+        date = datetime.fromisoformat(source['date'])
         orientation = source['orientation']
         exif_info = source['exif_info']
         stamp = source['stamp']
         hash = source['hash']
-        return Image(Path(path), date=date, orientation=orientation, exif_info=exif_info, stamp=stamp, hash=hash)
-
-    def __repr__(self):
-        return str(self.__dict__)
+        # Entries cached before placeholders are described again by resize workers
+        placeholder = source.get('placeholder')
+        dimensions = source.get('dimensions')
+        return Image(Path(path), date=date, orientation=orientation, exif_info=exif_info, stamp=stamp, hash=hash,
+                     placeholder=placeholder, dimensions=dimensions)
 
 
-class Video:
+class Video(MediaFile):
     VERSION = 1
+    __slots__ = ('_rendition',)
 
     def __init__(self, path: Path, exif: Exif = None, date=None, exif_info=None, stamp=None, hash=None):
-        self.path = path
         if exif:
-            self.date = exif.datetime_original
-            self.exif_info = exif.info()
-            self.stamp = file_stamp(self.VERSION, self.path)
-            self.hash = self._hash()
+            super().__init__(path, exif.datetime_original, exif.info(), file_stamp(self.VERSION, path),
+                             hash or hasher.hash(path))
         else:
-            self.date = date
-            self.exif_info = exif_info
-            self.stamp = stamp
-            self.hash = hash
-
-    @property
-    def id(self):
-        return self._hash_for(self.path.as_posix())
+            super().__init__(path, date, exif_info, stamp, hash)
+        self._rendition = None
 
     def uri(self, album_id):
-        cache_name = self._cache_name()
-        return Path('/album/{}/{}/{}.mp4'.format(album_id, 'video', cache_name))
+        if self._rendition is None:
+            self._rendition = self._cache_name()
+        return Path('/album/{}/{}/{}.mp4'.format(album_id, 'video', self._rendition))
 
     def cache_path(self, target, album_id):
         return Path(target, Path(self.uri(album_id)).relative_to('/'))
@@ -142,17 +255,11 @@ class Video:
     def _cache_name(self):
         return self._hash_for(self.hash)
 
-    def _hash_for(self, content):
-        return hashlib.blake2b(bytes(content, encoding='utf-8'), digest_size=32).hexdigest()
-
-    def _hash(self):
-        h = hashlib.blake2b()
-        with self.path.open('rb') as f:
-            buffer = f.read(2 * 1024 * 1024)
-            while buffer:
-                h.update(buffer)
-                buffer = f.read(2 * 1024 * 1024)
-        return h.hexdigest()
+    def render_key(self):
+        """
+        Fields that are used by templates
+        """
+        return [self.path.as_posix(), self.hash, self.exif_info]
 
     def serialize(self):
         return {'path': self.path.absolute().as_posix(),
@@ -168,24 +275,31 @@ class Video:
     @classmethod
     def deserialize(cls, source):
         path = source['path']
-        date = source['date']
+        date = datetime.fromisoformat(source['date'])
         exif_info = source['exif_info']
         stamp = source['stamp']
         hash = source['hash']
         return Video(Path(path), date=date, exif_info=exif_info, stamp=stamp, hash=hash)
 
-    def __repr__(self):
-        return str(self.__dict__)
-
 
 class ImageSet:
-    def __init__(self, path: Path, thumbnail, include, exclude, sortby, cache_manager: CacheManager):
+    __slots__ = ('path', 'thumbnail_path', 'include', 'exclude', 'sortby', '_cache', '_scanner',
+                 '_thumbnail', '_thumbnail_loaded', '_paths', '_loaded')
+
+    def __init__(self, path: Path, thumbnail, include, exclude, sortby, cache_manager: CacheManager,
+                 scanner: DirectoryScanner = None):
         self.path = path
         self.thumbnail_path = thumbnail
         self.include = self._split(include)
         self.exclude = self._split(exclude)
         self.sortby = sortby
         self._cache = cache_manager
+        self._scanner = scanner
+        self._thumbnail = None
+        self._thumbnail_loaded = False
+        # Found paths and loaded images, kept by set itself to be freed with removed album
+        self._paths = None
+        self._loaded = None
 
     def _split(self, value):
         if value:
@@ -197,48 +311,95 @@ class ImageSet:
             if not path.name.startswith('.'):
                 yield path
 
-    @cache
+    def _glob(self, pattern):
+        found = self._scanner.glob(self.path, pattern) if self._scanner else None
+        return self.path.glob(pattern) if found is None else found
+
     def _images(self):
-        result = set()
-        for i in self.include:
-            for p in self._filter_hidden(self.path.glob(i)):
-                result.add(p.absolute())
-        for i in self.exclude:
-            for p in self._filter_hidden(self.path.glob(i)):
-                result.remove(p.absolute())
-        return result
+        if self._paths is None:
+            result = set()
+            for i in self.include:
+                for p in self._filter_hidden(self._glob(i)):
+                    result.add(p.absolute())
+            for i in self.exclude:
+                for p in self._filter_hidden(self._glob(i)):
+                    result.remove(p.absolute())
+            self._paths = result
+        return self._paths
+
+    def _load_images(self):
+        if self._loaded is None:
+            images, missing = self._cache.load_items('images', Image, self._images())
+            if missing:
+                hashes = dict(zip(missing, hasher.submit(missing)))
+                images += [Image(p, e, hash=hashes[p].result()) for p, e in read_exif(missing)]
+            self._cache.save_list('images', images)
+            self._loaded = images
+        return self._loaded
 
     def images(self):
-        result = self._images()
-        images = self._cache.load_list('images', Image, result)
-        if not images:
-            images = [Image(p, e) for p, e in read_exif(list(result))] if result else []
-            self._cache.save_list('images', images)
-        return sorted(images, key=lambda x: getattr(x, self.sortby))
+        return sorted(self._load_images(), key=lambda x: getattr(x, self.sortby))
 
     def images_count(self):
         return len(self.images())
 
-    @cached_property
+    def save_previews(self, images):
+        """
+        Update cached entries of `images` with placeholders, thumbnail out of the set is not cached
+        """
+        cached = set(i.path for i in self._load_images())
+        self._cache.update_items('images', [i for i in images if i.path in cached])
+
+    @property
     def thumbnail(self):
+        if not self._thumbnail_loaded:
+            self._thumbnail = self._load_thumbnail()
+            self._thumbnail_loaded = True
+        return self._thumbnail
+
+    def _load_thumbnail(self):
         if self.thumbnail_path:
             thumbnail = Path(self.path, self.thumbnail_path)
             if thumbnail.exists():
-                path, exif = read_exif([thumbnail.absolute()])[0]
+                for image in self._load_images():
+                    if image.path == thumbnail.absolute():
+                        return image
+                found = read_exif([thumbnail.absolute()])
+                if not found:
+                    logger.warning('Album thumbnail %s is skipped', thumbnail)
+                    return None
+                path, exif = found[0]
                 return Image(path, exif=exif)
         return None
 
+    def __getstate__(self):
+        # Cache manager, scanner and loaded media stay in the main process
+        return dict(_slots_state(self), _cache=None, _scanner=None, _paths=None, _loaded=None)
+
+    def __setstate__(self, state):
+        _set_slots_state(self, state)
+
     def __repr__(self):
-        return str(self.__dict__)
+        return str(_slots_state(self))
 
 
 class VideoSet:
-    def __init__(self, path: Path, include, exclude, sortby, cache_manager: CacheManager):
+    FINGERPRINTS = ('full', 'sampled')
+    __slots__ = ('path', 'include', 'exclude', 'sortby', 'fingerprint', '_cache', '_scanner', '_paths', '_loaded')
+
+    def __init__(self, path: Path, include, exclude, sortby, cache_manager: CacheManager, fingerprint='full',
+                 scanner: DirectoryScanner = None):
         self.path = path
         self.include = self._split(include)
         self.exclude = self._split(exclude)
         self.sortby = sortby
+        self.fingerprint = fingerprint
         self._cache = cache_manager
+        self._scanner = scanner
+        self._paths = None
+        self._loaded = None
+        if fingerprint not in self.FINGERPRINTS:
+            raise Exception('Videos FINGERPRINT settings have to be one of {}'.format(', '.join(self.FINGERPRINTS)))
 
     def _split(self, value):
         if value:
@@ -250,31 +411,53 @@ class VideoSet:
             if not path.name.startswith('.'):
                 yield path
 
-    @cache
+    def _glob(self, pattern):
+        found = self._scanner.glob(self.path, pattern) if self._scanner else None
+        return self.path.glob(pattern) if found is None else found
+
     def _videos(self):
-        result = set()
-        for i in self.include:
-            for p in self._filter_hidden(self.path.glob(i)):
-                result.add(p.absolute())
-        for i in self.exclude:
-            for p in self._filter_hidden(self.path.glob(i)):
-                result.remove(p.absolute())
-        return result
+        if self._paths is None:
+            result = set()
+            for i in self.include:
+                for p in self._filter_hidden(self._glob(i)):
+                    result.add(p.absolute())
+            for i in self.exclude:
+                for p in self._filter_hidden(self._glob(i)):
+                    result.remove(p.absolute())
+            self._paths = result
+        return self._paths
+
+    def _load_videos(self):
+        if self._loaded is None:
+            # Hashes of different fingerprints are not interchangeable, keep them apart
+            key = 'videos' if self.fingerprint == 'full' else 'videos:{}'.format(self.fingerprint)
+            videos, missing = self._cache.load_items(key, Video, self._videos())
+            if missing:
+                hashes = dict(zip(missing, hasher.submit(missing, sampled=self.fingerprint == 'sampled')))
+                videos += [Video(p, exif=e, hash=hashes[p].result()) for p, e in read_exif(missing)]
+            self._cache.save_list(key, videos)
+            self._loaded = videos
+        return self._loaded
 
     def videos(self):
-        result = self._videos()
-        videos = self._cache.load_list('videos', Video, result)
-        if not videos:
-            videos = [Video(p, exif=e) for p, e in read_exif(list(result))] if result else []
-            self._cache.save_list('videos', videos)
-        return sorted(videos, key=lambda x: getattr(x, self.sortby))
+        return sorted(self._load_videos(), key=lambda x: getattr(x, self.sortby))
+
+    def __getstate__(self):
+        # Cache manager, scanner and loaded media stay in the main process
+        return dict(_slots_state(self), _cache=None, _scanner=None, _paths=None, _loaded=None)
+
+    def __setstate__(self, state):
+        _set_slots_state(self, state)
 
     def __repr__(self):
-        return str(self.__dict__)
+        return str(_slots_state(self))
 
 
 class Album:
-    def __init__(self, id, parent, title, description, date, tags, hidden, path, image_set, video_set):
+    __slots__ = ('id', 'parent', 'children', 'title', 'description', 'date', 'tags', 'hidden', 'path',
+                 'image_set', 'video_set', 'page_size')
+
+    def __init__(self, id, parent, title, description, date, tags, hidden, path, image_set, video_set, page_size=0):
         self.id = id
         self.parent = parent
         self.children = []
@@ -286,9 +469,37 @@ class Album:
         self.path = path
         self.image_set: ImageSet = image_set
         self.video_set: VideoSet = video_set
+        self.page_size = page_size
+        if page_size < 0:
+            raise Exception('Album PAGE_SIZE settings have to be not negative')
 
     def uri(self):
         return '/album/{}/'.format(self.id)
 
+    def page_uri(self, number):
+        return self.uri() if number == 1 else '/album/{}/page/{}/'.format(self.id, number)
+
+    def pages(self, images):
+        """
+        Split `images` by `page_size`, one page for all of them if it is 0
+        """
+        if not self.page_size or len(images) <= self.page_size:
+            return [images]
+        return [images[i:i + self.page_size] for i in range(0, len(images), self.page_size)]
+
+    def render_key(self):
+        """
+        Fields that are used by templates, without images and videos
+        """
+        thumbnail = self.image_set.thumbnail
+        return [self.id, self.parent, self.title, self.description, self.date, self.hidden,
+                thumbnail.render_key() if thumbnail else None]
+
+    def __getstate__(self):
+        return _slots_state(self)
+
+    def __setstate__(self, state):
+        _set_slots_state(self, state)
+
     def __repr__(self):
-        return str(self.__dict__)
+        return str(_slots_state(self))
@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
+import base64
+import copy
+import io
 import logging
 import os
 import shutil
-from typing import BinaryIO
+from pathlib import Path
+from typing import BinaryIO, List, Tuple, NamedTuple, Optional
 
 from PIL import Image
 
+from behappy.core.utils import atomic_file
+
 logger = logging.getLogger(__name__)
 
 
@@ -13,18 +19,131 @@ class ResizeOptions(object):
     """
     Options for resize such as width, height,
     max size - max of width/height,
-    crop - need or not.
+    crop - need or not,
+    format - output format, formats and widths - extra variants for srcset,
+    progressive, optimize, subsampling - JPEG encoder settings, strip - drop EXIF and XMP but keep ICC profile,
+    reencode_above - originals that fit the size are copied as is unless file is bigger than that many bytes.
     """
 
-    def __init__(self, width=0, height=0, crop=False, quality=95, name: str=None):
+    # Pillow format, file extension and mime type
+    FORMATS = {
+        'jpeg': ('JPEG', 'jpg', 'image/jpeg'),
+        'webp': ('WEBP', 'webp', 'image/webp'),
+        'avif': ('AVIF', 'avif', 'image/avif'),
+    }
+
+    # Speed to how many times bigger than target JPEG is decoded before final LANCZOS,
+    # None - decode at full resolution.
+    DRAFT_FACTORS = {
+        'quality': None,
+        'balanced': 2,
+        'fast': 1,
+    }
+
+    SUBSAMPLINGS = ('4:4:4', '4:2:2', '4:2:0')
+
+    def __init__(self, width=0, height=0, crop=False, quality=95, speed='balanced', format='jpeg',
+                 formats=(), widths=(), progressive=False, optimize=False, subsampling: Optional[str] = None,
+                 strip=False, reencode_above: Optional[int] = None, name: str=None):
         self.width = width
         self.height = height
         self.size = max(self.width, self.height)
         self.crop = crop
         self.quality = quality
+        self.speed = speed
+        self.format = format
+        self.formats = tuple(i for i in formats if i != format)
+        self.widths = tuple(sorted(set(i for i in widths if i != width)))
+        self.progressive = progressive
+        self.optimize = optimize
+        self.subsampling = subsampling if subsampling else None
+        self.strip = strip
+        self.reencode_above = reencode_above
         self.name = name if name else None
         if not (80 <= quality <= 100):
             raise Exception('Image QUALITY settings have to be between 80 and 100')
+        if speed not in self.DRAFT_FACTORS:
+            raise Exception('Image SPEED settings have to be one of {}'.format(', '.join(self.DRAFT_FACTORS)))
+        for i in (format, *self.formats):
+            if i not in self.FORMATS:
+                raise Exception('Image FORMATS settings have to be of {}'.format(', '.join(self.FORMATS)))
+        Image.init()
+        if self.FORMATS[format][0] not in Image.SAVE:
+            raise Exception('Image format {} is not supported by installed Pillow'.format(format))
+        # Extra formats are only an optimization, gallery is still built without them
+        unsupported = [i for i in self.formats if self.FORMATS[i][0] not in Image.SAVE]
+        if unsupported:
+            logger.warning('Image formats %s are not supported by installed Pillow, skipped', ', '.join(unsupported))
+            self.formats = tuple(i for i in self.formats if i not in unsupported)
+        if any(not (0 < i < width) for i in self.widths):
+            raise Exception('Image WIDTHS settings have to be less than WIDTH')
+        if self.subsampling and self.subsampling not in self.SUBSAMPLINGS:
+            raise Exception('Image SUBSAMPLING settings have to be one of {}'.format(', '.join(self.SUBSAMPLINGS)))
+        if reencode_above is not None and reencode_above < 0:
+            raise Exception('Image REENCODE_ABOVE settings have to be not negative')
+
+    @property
+    def key(self):
+        return self.name, self.format, self.width
+
+    @property
+    def encoder(self):
+        """
+        Not default encoder settings, they change rendition files
+        """
+        values = (('progressive', self.progressive, False), ('optimize', self.optimize, False),
+                  ('subsampling', self.subsampling, None), ('strip', self.strip, False),
+                  ('reencode_above', self.reencode_above, None))
+        return tuple((n, v) for n, v, default in values if v != default)
+
+    def save_params(self, image: 'BetterImage'):
+        """
+        Arguments of `PIL.Image.save` besides format and quality
+        """
+        params = {}
+        if self.format == 'jpeg':
+            if self.progressive:
+                params['progressive'] = True
+            if self.optimize:
+                params['optimize'] = True
+            if self.subsampling:
+                params['subsampling'] = self.subsampling
+        if self.strip and image.icc_profile:
+            params['icc_profile'] = image.icc_profile
+        return params
+
+    def need_reencode(self, file_size):
+        """
+        Whether an original that fits the size has to be encoded instead of copied
+        """
+        if self.strip:
+            return True
+        return self.reencode_above is not None and file_size > self.reencode_above
+
+    @property
+    def extension(self):
+        return self.FORMATS[self.format][1]
+
+    def variants(self):
+        """
+        This option and options for all extra formats and widths, narrow and modern formats first
+        """
+        result = []
+        for width in (*self.widths, self.width):
+            for fmt in (*self.formats, self.format):
+                if width == self.width and fmt == self.format:
+                    result.append(self)
+                else:
+                    result.append(ResizeOptions(width=width, height=round(self.height * width / self.width),
+                                                crop=self.crop, quality=self.quality, speed=self.speed,
+                                                format=fmt, progressive=self.progressive, optimize=self.optimize,
+                                                subsampling=self.subsampling, strip=self.strip,
+                                                reencode_above=self.reencode_above, name=self.name))
+        return result
+
+    @property
+    def draft_factor(self):
+        return self.DRAFT_FACTORS[self.speed]
 
     @classmethod
     def from_settings(cls, setting, name=None):
@@ -33,25 +152,68 @@ class ResizeOptions(object):
             height=setting['HEIGHT'],
             crop='CROP' in setting and setting['CROP'] is True,
             quality=setting.get('QUALITY', 95),
+            speed=setting.get('SPEED', 'balanced'),
+            formats=setting.get('FORMATS', ()),
+            widths=setting.get('WIDTHS', ()),
+            progressive=setting.get('PROGRESSIVE', False),
+            optimize=setting.get('OPTIMIZE', False),
+            subsampling=setting.get('SUBSAMPLING'),
+            strip=setting.get('STRIP', False),
+            reencode_above=setting.get('REENCODE_ABOVE'),
             name=name,
         )
 
     def __repr__(self):
-        return 'ImageOptions(width={w}, height={h}, crop={c}, quality={q}, name={n})' \
-            .format(w=self.width, h=self.height, c=self.crop, q=self.quality, n=self.name)
+        return 'ImageOptions(width={w}, height={h}, crop={c}, quality={q}, speed={s}, format={f}, encoder={e}, ' \
+               'name={n})'.format(w=self.width, h=self.height, c=self.crop, q=self.quality, s=self.speed,
+                                  f=self.format, e=self.encoder, n=self.name)
+
+
+class ResizeStats(NamedTuple):
+    """
+    Written renditions, their size and bytes saved by encoding originals instead of copying
+    """
+    written: int = 0
+    size: int = 0
+    saved: int = 0
+
+    def __add__(self, other):
+        return ResizeStats(*(a + b for a, b in zip(self, other)))
 
 
 class BetterImage(object):
     """
     Get file with image. Resize, rotate, crop it.
+    Image is opened lazily, call `draft` if need and then `load`.
     """
 
     def __init__(self, filein, orientation):
         self.file = Image.open(filein)
         self.orientation = orientation
+        self.type = 'JPEG'
+
+    def draft(self, width, height):
+        """
+        Configure JPEG decoder to scale image down by 1/2, 1/4 or 1/8
+        while it stays not less than `width` and `height`.
+        Does nothing for other formats or after `load`.
+        """
+        self.file.draft(None, (width, height))
+
+    def load(self):
+        """
+        Decode image and convert it to RGB if need
+        """
         if self.file.mode not in ('L', 'RGB'):
             self.file = self.file.convert('RGB')
-        self.type = 'JPEG'
+            # Profile of the original color space does not describe converted pixels
+            self.file.info.pop('icc_profile', None)
+        else:
+            self.file.load()
+
+    @property
+    def icc_profile(self):
+        return self.file.info.get('icc_profile')
 
     @property
     def width(self):
@@ -67,11 +229,12 @@ class BetterImage(object):
         """
         return self.file.size[1]
 
-    def resize(self, width, height):
+    def resize(self, width, height, reducing_gap=None):
         """
-        Resize image to `width` and `width`
+        Resize image to `width` and `width`.
+        With `reducing_gap` image is reduced by integer factor first, see `PIL.Image.resize`.
         """
-        self.file = self.file.resize((width, height), Image.Resampling.LANCZOS)
+        self.file = self.file.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=reducing_gap)
 
     def crop(self, x_offset, y_offset, width, height):
         """
@@ -96,6 +259,13 @@ class BetterImage(object):
         y_offset = int((self.height - height) / 2)
         self.crop(x_offset, y_offset, x_offset + width, y_offset + height)
 
+    def copy(self):
+        """
+        Return a copy that can be resized, cropped and rotated independently.
+        All operations replace `self.file`, so pixels are not duplicated.
+        """
+        return copy.copy(self)
+
     def is_portrait(self):
         """
         Is width < height
@@ -143,38 +313,144 @@ class BetterImage(object):
             height = int(self.height / scale)
             return width, height
 
-    def save_to(self, fout: BinaryIO, quality: int):
+    def save_to(self, fout: BinaryIO, quality: int, type: str = None, **params):
         """
-        Save to open file. Need to close by yourself.
+        Save to open file as `type`, JPEG by default, `params` are passed to encoder. Need to close by yourself.
         """
-        self.file.save(fout, self.type, quality=quality)
+        self.file.save(fout, type or self.type, quality=quality, **params)
 
 
 class ImageResizer:
+    # Intermediate rendition is reused as a source only if it is at least
+    # that many times bigger than the target, to keep LANCZOS quality.
+    CASCADE_FACTOR = 2
+    REDUCING_GAPS = {
+        'fast': 2.0,
+    }
+    # Max side of inline placeholder, browser blurs it on scaling up
+    PLACEHOLDER_SIZE = 16
+
+    def __init__(self, fsync=False):
+        self.fsync = fsync
+
     def resize(self, from_path, to_path, option, orientation):
-        if not to_path.exists():
-            to_path.parent.mkdir(parents=True, exist_ok=True)
-            with from_path.open(mode='rb') as fin:
-                resize_image = BetterImage(fin, orientation)
-                bigger = resize_image.is_bigger(option.width, option.height)
-                if bigger:
+        return self.resize_all(from_path, [(to_path, option)], orientation).written > 0
+
+    def resize_all(self, from_path: Path, renditions: List[Tuple[Path, ResizeOptions]], orientation):
+        """
+        Decode `from_path` once and write all missing `renditions` - list of (to_path, option).
+        Bigger sizes go first, smaller ones are scaled down from the bigger intermediates.
+        Renditions of the same size in different formats are encoded from one resized image.
+        Return `ResizeStats` of written files.
+        """
+        missing = [(p, o) for p, o in renditions if not p.exists()]
+        if not missing:
+            return ResizeStats()
+        stats = ResizeStats()
+        original_size = from_path.stat().st_size
+        missing.sort(key=lambda x: x[1].size, reverse=True)
+        with from_path.open(mode='rb') as fin:
+            original = BetterImage(fin, orientation)
+            plan = []
+            for to_path, option in missing:
+                if original.is_bigger(option.width, option.height):
                     if option.crop:
-                        w, h = resize_image.scale_min_size(option.size)
-                        resize_image.resize(w, h)
-                        resize_image.crop_center(option.width, option.height)
+                        size = original.scale_min_size(option.size)
                     else:
-                        w, h = resize_image.scale_to(option.width, option.height)
-                        resize_image.resize(w, h)
+                        size = original.scale_to(option.width, option.height)
+                else:
+                    size = None
+                plan.append((to_path, option, size))
 
-                if resize_image.need_rotate():
-                    resize_image.rotate()
+            draft_size = self._draft_size(plan)
+            if draft_size:
+                original.draft(*draft_size)
+            original.load()
 
-                if bigger or resize_image.need_rotate():
-                    with to_path.open(mode='wb') as fout:
-                        resize_image.save_to(fout, option.quality)
+            sources = [original]
+            resized = {}
+            for to_path, option, size in plan:
+                to_path.parent.mkdir(parents=True, exist_ok=True)
+                bigger = size is not None
+                geometry = (size, option.crop and (option.width, option.height))
+                if geometry in resized:
+                    resize_image = resized[geometry]
+                elif bigger:
+                    w, h = size
+                    resize_image = self._nearest_source(sources, w, h).copy()
+                    resize_image.resize(w, h, reducing_gap=self.REDUCING_GAPS.get(option.speed))
+                    sources.append(resize_image.copy())
+                    if option.crop:
+                        resize_image.crop_center(option.width, option.height)
+                    resize_image.rotate()
                 else:
-                    shutil.copy2(from_path.as_posix(), to_path.as_posix())
+                    resize_image = original.copy()
+                    resize_image.rotate()
+                resized[geometry] = resize_image
 
-            os.chmod(to_path.as_posix(), 0o644)
-            return True
-        return False
+                saved = 0
+                # Existing file is treated as done, so it appears only when complete
+                with atomic_file(to_path, self.fsync) as tmp:
+                    if bigger or resize_image.need_rotate() or option.format != 'jpeg':
+                        self._save(resize_image, tmp, option)
+                    elif option.need_reencode(original_size):
+                        self._save(resize_image, tmp, option)
+                        saved = original_size - tmp.stat().st_size
+                        if saved <= 0 and not option.strip:
+                            # Original is already compressed better
+                            shutil.copy2(from_path.as_posix(), tmp.as_posix())
+                        # Stripped file is kept even if it is bigger, growth is not a saving
+                        saved = max(saved, 0)
+                    else:
+                        shutil.copy2(from_path.as_posix(), tmp.as_posix())
+                    os.chmod(tmp.as_posix(), 0o644)
+                stats += ResizeStats(1, to_path.stat().st_size, saved)
+        return stats
+
+    def describe(self, paths: List[Path]):
+        """
+        Real sizes of rendition files by name and a tiny placeholder of the smallest one as data URI.
+        Only headers are read to get sizes, the smallest file is decoded at 1/8 scale if possible.
+        """
+        sizes = {}
+        for path in paths:
+            with Image.open(path) as img:
+                sizes[path.stem] = img.size
+        smallest = min(paths, key=lambda x: sizes[x.stem][0] * sizes[x.stem][1])
+        with Image.open(smallest) as img:
+            img.draft('RGB', (self.PLACEHOLDER_SIZE, self.PLACEHOLDER_SIZE))
+            img = img.convert('RGB')
+            img.thumbnail((self.PLACEHOLDER_SIZE, self.PLACEHOLDER_SIZE), Image.Resampling.LANCZOS)
+            fmt = 'WEBP' if 'WEBP' in Image.SAVE else 'JPEG'
+            buffer = io.BytesIO()
+            img.save(buffer, fmt, quality=60)
+        placeholder = 'data:image/{};base64,{}'.format(fmt.lower(), base64.b64encode(buffer.getvalue()).decode())
+        return placeholder, sizes
+
+    def _save(self, image: BetterImage, to_path: Path, option: ResizeOptions):
+        with to_path.open(mode='wb') as fout:
+            image.save_to(fout, option.quality, ResizeOptions.FORMATS[option.format][0], **option.save_params(image))
+
+    def _draft_size(self, plan):
+        """
+        Minimal decoded size that is enough for every rendition in `plan`,
+        None if some of them need image at full resolution.
+        """
+        width, height = 0, 0
+        for _, option, size in plan:
+            factor = option.draft_factor
+            if size is None or factor is None:
+                return None
+            width = max(width, size[0] * factor)
+            height = max(height, size[1] * factor)
+        return width, height
+
+    def _nearest_source(self, sources: List[BetterImage], width, height):
+        """
+        Smallest decoded image that is still big enough to be scaled to `width` x `height`
+        """
+        factor = self.CASCADE_FACTOR
+        suitable = [i for i in sources if i.width >= width * factor and i.height >= height * factor]
+        if suitable:
+            return min(suitable, key=lambda x: x.width)
+        return sources[0]
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+from fnmatch import fnmatchcase
+from pathlib import Path
+from time import time_ns
+from typing import List, Optional
+
+import orjson
+
+from behappy.core.utils import atomic_write
+
+
+class DirectoryScanner:
+    """
+    Walk source folders with `os.scandir` and remember every directory listing with its mtime.
+    On the next scan only directories with changed mtime are listed again, others are just stat-ed.
+    Entries matched by `ignore` globs are skipped with their subtrees.
+    Listings are used to find album files in memory instead of globbing the disk again.
+    Paths are kept as given, same as `os.walk`, so media ids do not depend on how they were found.
+    """
+    # Directory changed that recently can be changed again within the same mtime tick
+    RACY_NS = 2 * 10 ** 9
+
+    def __init__(self, cache_path: Optional[Path], ignore: List[str]):
+        self.cache_path = cache_path
+        self.ignore = ignore
+        self.listed = 0
+        self.reused = 0
+        self._saved = {}
+        self._dirs = {}
+        if cache_path and cache_path.exists():
+            state = orjson.loads(cache_path.read_bytes())
+            if state.get('ignore') == ignore:
+                self._saved = state['dirs']
+
+    def scan(self, roots: List[Path]):
+        started = time_ns()
+        for root in roots:
+            self._scan(root.as_posix(), started)
+
+    def rescan(self, roots: List[Path]):
+        """
+        Scan again reusing listings in memory, return folders that are added, removed or changed
+        """
+        previous, self._saved, self._dirs = self._dirs, self._dirs, {}
+        self.listed = 0
+        self.reused = 0
+        self.scan(roots)
+        folders = previous.keys() | self._dirs.keys()
+        return [Path(i) for i in folders if self._changed(previous.get(i), self._dirs.get(i))]
+
+    def save(self):
+        if self.cache_path and self.listed:
+            atomic_write(self.cache_path, orjson.dumps({'ignore': self.ignore, 'dirs': self._dirs}))
+
+    def search(self, pattern: re.Pattern):
+        """
+        All scanned files which names match `pattern`
+        """
+        results = []
+        for folder, (_, files, _) in self._dirs.items():
+            for name in files:
+                if pattern.match(name):
+                    results.append(Path(folder, name))
+        return results
+
+    def glob(self, folder: Path, pattern: str):
+        """
+        Same as `folder.glob(pattern)` for files, but from the scanned listings.
+        Return None if `folder` was not scanned or pattern goes out of it.
+        """
+        parts = [i for i in pattern.split('/') if i not in ('', '.')]
+        folder = folder.as_posix()
+        if not parts or '..' in parts or folder not in self._dirs:
+            return None
+        return list(self._glob(folder, parts))
+
+    def _glob(self, folder: str, parts: List[str]):
+        entry = self._dirs.get(folder)
+        if entry is None:
+            return
+        _, files, dirs = entry
+        head, rest = parts[0], parts[1:]
+        if head == '**':
+            if rest:
+                yield from self._glob(folder, rest)
+            for name in dirs:
+                yield from self._glob(os.path.join(folder, name), parts)
+        elif not rest:
+            for name in files:
+                if fnmatchcase(name, head):
+                    yield Path(folder, name)
+        else:
+            for name in dirs:
+                if fnmatchcase(name, head):
+                    yield from self._glob(os.path.join(folder, name), rest)
+
+    def _scan(self, folder: str, started: int):
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+        except FileNotFoundError:
+            return
+        saved = self._saved.get(folder)
+        if saved and saved[0] == mtime:
+            _, files, dirs = saved
+            self.reused += 1
+        else:
+            files, dirs = [], []
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if self._ignored(entry.name):
+                        continue
+                    if not entry.is_dir():
+                        files.append(entry.name)
+                    elif not entry.is_symlink():
+                        # Same as os.walk, do not follow links to directories
+                        dirs.append(entry.name)
+            self.listed += 1
+            if started - mtime < self.RACY_NS:
+                mtime = 0
+        self._dirs[folder] = (mtime, files, dirs)
+        for name in dirs:
+            self._scan(os.path.join(folder, name), started)
+
+    def _changed(self, before, after):
+        if before is None or after is None or before[1:] != after[1:]:
+            return True
+        # Racy mtime was zeroed on the previous scan, same listing with real mtime is not a change
+        return before[0] != 0 and before[0] != after[0]
+
+    def _ignored(self, name):
+        return any(fnmatchcase(name, i) for i in self.ignore)
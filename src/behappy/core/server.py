@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import functools
+import os
+import re
+import shutil
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import List
+from urllib.parse import urlsplit, urlunsplit
+
+from behappy.core.headers import HeaderPolicy, HeaderOptions, fresh_sidecar
+
+# Renditions and videos are named by blake2b of content
+HASHED_NAME = re.compile(r'^[0-9a-f]{64}$')
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class GalleryRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serve build folder close to production: byte ranges for video seeking, strong ETags with `If-None-Match`,
+    precompressed sidecars by `Accept-Encoding` and headers of `HeaderPolicy`.
+    Hidden files are not served, missing ones get error/404.html.
+    """
+    # Preferred first
+    ENCODINGS = ('br', 'gzip')
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, *args, policy: HeaderPolicy = None, **kwargs):
+        self.policy = policy
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        self._serve(with_body=True)
+
+    def do_HEAD(self):
+        self._serve(with_body=False)
+
+    def _serve(self, with_body):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            url = urlsplit(self.path)
+            if not url.path.endswith('/'):
+                self.send_response(HTTPStatus.MOVED_PERMANENTLY)
+                self.send_header('Location', urlunsplit(url._replace(path=url.path + '/')))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            path = os.path.join(path, 'index.html')
+        if os.path.basename(path).startswith('.') or not os.path.isfile(path):
+            self._send_not_found(with_body)
+            return
+
+        original = Path(path)
+        key = original.relative_to(self.directory).as_posix()
+        encoding = self._encoding(original)
+        file = fresh_sidecar(original, encoding) if encoding else original
+        stat = file.stat()
+        etag = self._etag(original, stat, encoding)
+        if self._not_modified(etag):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        size = stat.st_size
+        start, end = 0, size - 1
+        status = HTTPStatus.OK
+        requested = self._range(etag)
+        if requested:
+            span = self._span(requested, size)
+            if span is None:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            start, end = span
+            status = HTTPStatus.PARTIAL_CONTENT
+
+        self.send_response(status)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(stat.st_mtime))
+        if status == HTTPStatus.PARTIAL_CONTENT:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if self._encodings(original):
+            self.send_header('Vary', 'Accept-Encoding')
+        cache_control = self.policy.headers(key).get('CacheControl') if self.policy else None
+        if cache_control:
+            self.send_header('Cache-Control', cache_control)
+        self.end_headers()
+        if with_body:
+            self._send_file(file, start, end - start + 1)
+
+    def _encodings(self, path: Path):
+        """
+        Encodings with fresh sidecars of `path`
+        """
+        return [i for i in self.ENCODINGS if fresh_sidecar(path, i)]
+
+    def _encoding(self, path: Path):
+        accepted = set()
+        for item in self.headers.get('Accept-Encoding', '').split(','):
+            name, _, params = item.partition(';')
+            key, _, value = params.partition('=')
+            try:
+                quality = float(value) if key.strip() == 'q' else 1.0
+            except ValueError:
+                quality = 0.0
+            if quality > 0:
+                accepted.add(name.strip().lower())
+        return next((i for i in self._encodings(path) if i in accepted), None)
+
+    def _etag(self, path: Path, stat: os.stat_result, encoding):
+        if HASHED_NAME.match(path.stem):
+            tag = path.stem
+        else:
+            tag = '{:x}-{:x}'.format(stat.st_mtime_ns, stat.st_size)
+        return '"{}-{}"'.format(tag, encoding) if encoding else '"{}"'.format(tag)
+
+    def _not_modified(self, etag):
+        tags = [i.strip() for i in self.headers.get('If-None-Match', '').split(',')]
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+
+    def _range(self, etag):
+        """
+        Requested single byte range if it still applies to current file, multiple ranges are not supported
+        """
+        value = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if not value or (if_range and if_range != etag):
+            return None
+        return RANGE.match(value.strip())
+
+    def _span(self, requested, size):
+        first, last = requested.groups()
+        if not first and not last:
+            return None
+        if not first:
+            length = int(last)
+            if length == 0 or size == 0:
+                return None
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if start >= size or start > end:
+            return None
+        return start, end
+
+    def _send_file(self, path: Path, start, length):
+        try:
+            with path.open('rb') as f:
+                f.seek(start)
+                while length > 0:
+                    chunk = f.read(min(self.CHUNK_SIZE, length))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    length -= len(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            # Browser stops video download on seeking
+            pass
+
+    def _send_not_found(self, with_body):
+        page = Path(self.directory, 'error', '404.html')
+        if not page.is_file():
+            self.send_error(HTTPStatus.NOT_FOUND, 'File not found')
+            return
+        self.send_response(HTTPStatus.NOT_FOUND)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(page.stat().st_size))
+        self.end_headers()
+        if with_body:
+            with page.open('rb') as f:
+                shutil.copyfileobj(f, self.wfile)
+
+
+def create_server(target: str, port: int, header_options: List[HeaderOptions] = None, host='0.0.0.0'):
+    policy = HeaderPolicy(header_options) if header_options else None
+    handler = functools.partial(GalleryRequestHandler, directory=target, policy=policy)
+    return ThreadingHTTPServer((host, port), handler)
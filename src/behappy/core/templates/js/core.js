@@ -80,6 +80,12 @@ var core = {
             jQuery('.album img[data-src]').each(function (i, img) {
                 var image = jQuery(img);
                 if (image.offset().top < height) {
+                    // Sources first, so browser downloads only the chosen one
+                    image.siblings('source[data-srcset]').each(function (j, source) {
+                        source = jQuery(source);
+                        source.attr('srcset', source.attr('data-srcset'));
+                        source.removeAttr('data-srcset');
+                    });
                     image.attr('src', image.attr('data-src'));
                     image.removeAttr('data-src');
                 }
@@ -0,0 +1,54 @@
+import pickle
+from pathlib import Path
+from unittest import TestCase
+
+from behappy.core.conf import Settings
+from behappy.core.headers import HeaderPolicy
+
+
+class TestSettings(TestCase):
+
+    def setUp(self):
+        self.settings = Settings()
+        self.settings.load(Path(__file__).parent.parent.parent / 'samples' / 'behappy.gallery.ini')
+
+    def test_image_options(self):
+        small = self.settings.image_options()['small']
+        self.assertEqual((small.width, small.height, small.crop, small.speed), (960, 960, True, 'fast'))
+        self.assertIs(self.settings.image_options()['small'], small)
+        self.assertEqual(self.settings.image_size('big'),
+                         {'WIDTH': 4096, 'HEIGHT': 2304, 'CROP': False, 'SPEED': 'balanced', 'FORMATS': [], 'WIDTHS': [],
+                          'PROGRESSIVE': True, 'OPTIMIZE': True, 'STRIP': True, 'SUBSAMPLING': '4:2:0',
+                          'REENCODE_ABOVE': 512 * 1024})
+
+    def test_read_only(self):
+        with self.assertRaises(TypeError):
+            self.settings.image_size('big')['WIDTH'] = 1
+        with self.assertRaises(TypeError):
+            self.settings.image_options()['huge'] = self.settings.image_options()['big']
+        self.settings.templates_parameters()['copyright']['username'] = 'Other'
+        self.assertEqual(self.settings.copyright()['username'], 'User')
+
+    def test_image_variants(self):
+        variants = [i.key for i in self.settings.image_variants()]
+        self.assertEqual(variants, [('small', 'webp', 480), ('small', 'jpeg', 480),
+                                    ('small', 'webp', 960), ('small', 'jpeg', 960),
+                                    ('big', 'jpeg', 4096)])
+        self.assertEqual(self.settings.image_variants()[0].height, 480)
+
+    def test_header_options(self):
+        options = self.settings.header_options()
+        self.assertEqual([i.name for i in options], ['renditions', 'pages', 'assets'])
+        policy = HeaderPolicy(options)
+        self.assertEqual(policy.headers('album/a1/big/abc.jpg'),
+                         {'ContentType': 'image/jpeg', 'CacheControl': 'public, max-age=31536000, immutable'})
+        self.assertEqual(policy.encoding('year/2020/index.html'), 'gzip')
+        self.assertEqual(policy.headers('robots.txt')['ContentEncoding'], 'gzip')
+        self.assertEqual(policy.headers('img/favicon.ico'), {'ContentType': 'image/vnd.microsoft.icon'})
+
+    def test_snapshot(self):
+        restored = Settings()
+        restored.restore(pickle.loads(pickle.dumps(self.settings.snapshot())))
+        self.assertEqual(restored.title(), 'Welcome')
+        self.assertEqual(restored.templates_parameters(), self.settings.templates_parameters())
+        self.assertEqual(restored.image_options()['big'].size, 4096)
@@ -0,0 +1,38 @@
+import gzip
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from behappy.core.headers import write_sidecar, fresh_sidecar, sidecar_source, sidecar_path, compressible
+
+
+class TestSidecars(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.page = Path(self.tmp.name, 'index.html')
+        self.page.write_bytes(b'<html></html>')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_write_sidecar(self):
+        self.assertTrue(write_sidecar(self.page, 'gzip'))
+        sidecar = sidecar_path(self.page, 'gzip')
+        self.assertEqual(gzip.decompress(sidecar.read_bytes()), b'<html></html>')
+        self.assertEqual(sidecar_source(sidecar), (self.page, 'gzip'))
+        self.assertFalse(write_sidecar(self.page, 'gzip'))
+
+    def test_stale_sidecar(self):
+        write_sidecar(self.page, 'gzip')
+        self.page.write_bytes(b'<html>changed</html>')
+        os.utime(self.page, ns=(0, 10 ** 9))
+        self.assertIsNone(fresh_sidecar(self.page, 'gzip'))
+        self.assertTrue(write_sidecar(self.page, 'gzip'))
+        self.assertEqual(gzip.decompress(fresh_sidecar(self.page, 'gzip').read_bytes()), b'<html>changed</html>')
+
+    def test_compressible(self):
+        self.assertTrue(compressible(Path('css/core.css')))
+        self.assertTrue(compressible(Path('js/core.js')))
+        self.assertFalse(compressible(Path('album/a1/small/1.jpg')))
@@ -0,0 +1,444 @@
+import gzip
+import io
+import os
+import threading
+from multiprocessing.pool import Pool, ThreadPool
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from unittest import TestCase, skipIf
+from unittest.mock import patch, Mock
+
+import boto3
+from jinja2 import PackageLoader
+from PIL import Image
+
+from behappy.core.conf import settings
+from behappy.core.headers import HeaderOptions, write_sidecar
+from behappy.core.main import BeHappy, BeHappySync, ResizeQueue, PageWriter, _init_worker
+from behappy.core.resize import ResizeStats
+from behappy.core.utils import Exif
+
+try:
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+
+GALLERY_INI = """
+[gallery]
+source = {source}
+title = Welcome
+description = Test gallery
+
+[images:small]
+width = 64
+height = 64
+crop = true
+
+[images:big]
+width = 128
+height = 96
+
+[about]
+title = About
+text = Text
+
+[copyright]
+username = User
+email = mailto:user@mail.com
+"""
+
+ALBUM_INI = """
+[album]
+id = {id}
+title = {id}
+description = Album {id}
+date = 2020-01-01
+{extra}
+
+[images]
+thumbnail = 0.jpg
+include = *.jpg
+
+[videos]
+include = *.mp4
+"""
+
+
+class GalleryTestCase(TestCase):
+    """
+    Gallery with albums in temporary folder, exif is made up of file names instead of exiftool
+    """
+    ALBUMS = {'a1': 3, 'a2': 2}
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.source = Path(self.root, 'source')
+        self.target = Path(self.root, 'target')
+        for id, count in self.ALBUMS.items():
+            self.add_album(id, count)
+        conf = Path(self.root, 'behappy.gallery.ini')
+        conf.write_text(GALLERY_INI.format(source=self.source))
+        snapshot = settings.snapshot()
+        settings.load(conf)
+        self.addCleanup(settings.restore, snapshot)
+        exif = patch('behappy.core.model.read_exif', side_effect=self._read_exif)
+        exif.start()
+        self.addCleanup(exif.stop)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def add_album(self, id, count, extra=''):
+        folder = Path(self.source, id)
+        folder.mkdir(parents=True)
+        Path(folder, 'behappy.ini').write_text(ALBUM_INI.format(id=id, extra=extra))
+        for i in range(count):
+            Image.new('RGB', (200, 150), color=(40 * i, 60, 30)).save(Path(folder, '{}.jpg'.format(i)), 'JPEG')
+
+    def _read_exif(self, paths):
+        return [(i, Exif({'File:FileName': i.name, 'EXIF:DateTimeOriginal': '2020:01:01 10:00:0{}'.format(n % 10)}))
+                for n, i in enumerate(paths) if i.exists()]
+
+    def build(self):
+        """
+        Build gallery, return its output
+        """
+        with patch('sys.stdout', new_callable=io.StringIO) as out:
+            BeHappy(self.target.as_posix(), set()).build(processes=2)
+        return out.getvalue()
+
+
+class TestPageWriter(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.state = Path(self.root, '.behappy.pages.json')
+        self.page = Path(self.root, 'album', 'a1', 'index.html')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _write(self, salt, key):
+        pages = PageWriter(self.root, self.state, salt)
+        render = Mock(return_value='<html>{}</html>'.format(key))
+        written = pages.write(self.page, key, render)
+        pages.save()
+        self.assertEqual(render.called, written)
+        return written
+
+    def test_write(self):
+        self.assertTrue(self._write(['template'], ['a1', 1]))
+        self.assertFalse(self._write(['template'], ['a1', 1]))
+        self.assertTrue(self._write(['template'], ['a1', 2]))
+        self.assertTrue(self._write(['changed template'], ['a1', 2]))
+        self.assertFalse(self._write(['changed template'], ['a1', 2]))
+        self.page.unlink()
+        self.assertTrue(self._write(['changed template'], ['a1', 2]))
+
+
+class TestBeHappy(GalleryTestCase):
+
+    def test_rebuild_pages(self):
+        self.assertIn('\n6 pages changed\n', self.build())
+        self.assertIn('\n0 pages changed\n', self.build())
+
+        get_source = PackageLoader.get_source
+
+        def changed_template(loader, environment, template):
+            source, filename, uptodate = get_source(loader, environment, template)
+            return source.replace('Slideshow', 'Play') if template == 'album.jinja2' else source, filename, uptodate
+
+        with patch.object(PackageLoader, 'get_source', autospec=True, side_effect=changed_template):
+            self.assertIn('\n6 pages changed\n', self.build())
+        self.assertIn('Play', Path(self.target, 'album', 'a1', 'index.html').read_text())
+
+        conf = Path(self.root, 'behappy.gallery.ini')
+        conf.write_text(conf.read_text().replace('username = User', 'username = Other'))
+        settings.load(conf)
+        self.assertIn('\n6 pages changed\n', self.build())
+        self.assertIn('Other', Path(self.target, 'index.html').read_text())
+
+    def test_verify(self):
+        video = Path(self.source, 'a1', 'clip.mp4')
+        video.write_bytes(os.urandom(64 * 1024))
+        self.build()
+        copy = next(Path(self.target, 'album', 'a1', 'video').iterdir())
+        content = bytearray(copy.read_bytes())
+        content[1000] ^= 0xFF
+        copy.write_bytes(content)
+
+        with patch('sys.stdout', new_callable=io.StringIO):
+            self.assertEqual(BeHappy(self.target.as_posix(), set()).verify(processes=2, fix=False), 1)
+            self.assertNotEqual(copy.read_bytes(), video.read_bytes())
+            self.assertEqual(BeHappy(self.target.as_posix(), set()).verify(processes=2, fix=True), 1)
+            self.assertEqual(copy.read_bytes(), video.read_bytes())
+            self.assertEqual(BeHappy(self.target.as_posix(), set()).verify(processes=2, fix=False), 0)
+
+    def test_reload(self):
+        blog = BeHappy(self.target.as_posix(), set())
+        try:
+            with patch('sys.stdout', new_callable=io.StringIO) as out, \
+                    Pool(processes=2, initializer=_init_worker, initargs=(settings.snapshot(),)) as pool:
+                blog._load(processes=2)
+                blog._publish(pool, 2, blog.gallery.albums())
+                self.assertEqual(blog._reload(2, set()), [])
+
+                # Photo edited in place is found by its path, only its album is published again
+                photo = Path(self.source, 'a1', '1.jpg')
+                Image.new('RGB', (150, 200), color=(0, 0, 255)).save(photo, 'JPEG')
+                albums = blog._reload(2, {photo})
+                self.assertEqual([i.id for i in albums], ['a1'])
+                names = set(Path(self.target, 'album', 'a1', 'big').iterdir())
+                out.seek(0)
+                out.truncate()
+                blog._publish(pool, 2, albums)
+                self.assertEqual(len(set(Path(self.target, 'album', 'a1', 'big').iterdir()) - names), 1)
+                self.assertIn('\talbum/a1/index.html\n', out.getvalue())
+                self.assertNotIn('\talbum/a2/index.html\n', out.getvalue())
+
+                # New album is found by rescan of folders and changes gallery wide pages too
+                self.add_album('a3', 1)
+                albums = blog._reload(2, set())
+                self.assertEqual([i.id for i in albums], ['a3'])
+                out.seek(0)
+                out.truncate()
+                blog._publish(pool, 2, albums)
+                self.assertIn('\n3 pages changed\n', out.getvalue())
+                self.assertIn('a3', Path(self.target, 'index.html').read_text())
+        finally:
+            blog._close_store()
+
+    def test_pages(self):
+        conf = Path(self.root, 'behappy.gallery.ini')
+        conf.write_text(conf.read_text().replace('description = Test gallery', 'description = Test gallery\npage_size = 2'))
+        settings.load(conf)
+        self.add_album('a3', 3, extra='page_size = 0')
+        self.build()
+        page = Path(self.target, 'album', 'a1', 'page', '2', 'index.html')
+        self.assertIn('/album/a1/page/2/', Path(self.target, 'album', 'a1', 'index.html').read_text())
+        self.assertTrue(page.exists())
+        self.assertFalse(Path(self.target, 'album', 'a2', 'page').exists())
+        self.assertFalse(Path(self.target, 'album', 'a3', 'page').exists())
+
+        # Leftovers of builds with more pages are removed, so is the whole folder when album fits one page
+        leftover = Path(self.target, 'album', 'a1', 'page', '3')
+        leftover.mkdir()
+        self.build()
+        self.assertTrue(page.exists())
+        self.assertFalse(leftover.exists())
+        ini = Path(self.source, 'a1', 'behappy.ini')
+        ini.write_text(ini.read_text().replace('date = 2020-01-01', 'date = 2020-01-01\npage_size = 3'))
+        self.build()
+        self.assertFalse(Path(self.target, 'album', 'a1', 'page').exists())
+
+    def test_temp_files(self):
+        self.build()
+        temps = [Path(self.target, 'album', 'a1', 'small', '.a.jpg.{}.tmp'.format('0' * 32)),
+                 Path(self.target, '.behappy.pages.json.{}.tmp'.format('1' * 32)),
+                 Path(self.source, 'a1', '.behappy.cache.json.{}.tmp'.format('2' * 32))]
+        for i in temps:
+            i.write_bytes(b'half')
+        self.assertIn('\nRemoved 3 temporary files of interrupted build\n', self.build())
+        self.assertFalse(any(i.exists() for i in temps))
+
+    def test_compress_files(self):
+        conf = Path(self.root, 'behappy.gallery.ini')
+        conf.write_text(conf.read_text() + '\n[compress]\nencodings = gzip\n')
+        settings.load(conf)
+        self.build()
+        for name in ('index.html', 'album/a1/index.html', 'css/core.css', 'error/404.html'):
+            self.assertTrue(Path(self.target, name + '.gz').exists(), name)
+        stale = Path(self.target, 'album', 'a1', 'removed.html.gz')
+        stale.write_bytes(b'')
+        self.assertIn('\n0 sidecars written, 1 removed\n', self.build())
+        self.assertFalse(stale.exists())
+        self.assertFalse(any(i.name.endswith('.gz') for i in Path(self.target, 'album', 'a1', 'big').iterdir()))
+
+    def test_pool_render(self):
+        blog = BeHappy(self.target.as_posix(), set())
+        with patch('sys.stdout', new_callable=io.StringIO):
+            blog.build(processes=2)
+
+        for album in blog.gallery.albums():
+            for path, params, _ in blog._album_pages(album):
+                html = blog.jinja.get_template('album.jinja2').render(**params, **settings.templates_parameters())
+                self.assertEqual(path.read_text(), html)
+
+
+class TestResizeQueue(TestCase):
+
+    def _album(self, id, count):
+        album = SimpleNamespace(id=id, title=id.upper())
+        tasks = [(id, SimpleNamespace(path=Path(id, '{}.jpg'.format(i))), [None, None], []) for i in range(count)]
+        return album, tasks
+
+    def test_run(self):
+        albums = [self._album('a1', 3), self._album('empty', 0), self._album('a2', 2)]
+        release = threading.Event()
+        started = []
+
+        def resize(task):
+            started.append(task)
+            release.wait(timeout=5)
+            return task[0], ResizeStats(written=2, size=10), task[1].path.as_posix(), None
+
+        queue = ResizeQueue(size=3)
+        with ThreadPool(8) as pool, patch('behappy.core.main._resize_image', resize), \
+                patch('sys.stdout', new_callable=io.StringIO) as out:
+            thread = threading.Thread(target=queue.run, args=(pool, iter(albums)))
+            thread.start()
+            thread.join(timeout=0.3)
+            # Pool has free workers, but only `size` tasks are given to it
+            self.assertEqual(len(started), 3)
+            # Empty album is reported by the consuming thread with the next result
+            self.assertEqual(out.getvalue(), '')
+            release.set()
+            thread.join(timeout=5)
+
+        self.assertEqual(len(started), 5)
+        self.assertEqual(out.getvalue().splitlines(), [
+            '[EMPTY] 0 of 0 resizes',
+            '[A1] 6 of 6 resizes',
+            '[A2] 4 of 4 resizes',
+            '10 resizes, 0.0 MB written, 0.0 MB saved by re-encoding originals',
+        ])
+
+    def test_run_empty(self):
+        with ThreadPool(2) as pool, patch('sys.stdout', new_callable=io.StringIO) as out:
+            ResizeQueue(size=2).run(pool, iter([self._album('e1', 0), self._album('e2', 0)]))
+        self.assertEqual(out.getvalue().splitlines()[:2], ['[E1] 0 of 0 resizes', '[E2] 0 of 0 resizes'])
+
+
+@skipIf(mock_aws is None, 'moto is not installed')
+class TestBeHappySync(TestCase):
+    MB = 1024 * 1024
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.files = {
+            'index.html': b'<html></html>',
+            'css/style.css': b'body {}',
+            'album/a1/small/1.jpg': b'jpg',
+            'album/a1/small/1.webp': b'webp',
+            'album/a1/page/2/index.html': b'<html></html>',
+            'album/a1/video/1.mp4': os.urandom(11 * self.MB),
+        }
+        for name, content in self.files.items():
+            Path(self.root, name).parent.mkdir(parents=True, exist_ok=True)
+            Path(self.root, name).write_bytes(content)
+        env = patch.dict(os.environ, AWS_ACCESS_KEY_ID='testing', AWS_SECRET_ACCESS_KEY='testing',
+                         AWS_DEFAULT_REGION='us-east-1')
+        env.start()
+        self.addCleanup(env.stop)
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        self.s3 = boto3.client('s3')
+        self.s3.create_bucket(Bucket='gallery')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _sync(self):
+        with patch.object(BeHappySync, 'MULTIPART_CHUNKSIZE', 5 * self.MB):
+            return BeHappySync(self.root, None, None, 'gallery').s3()
+
+    def _keys(self):
+        return sorted(i['Key'] for i in self.s3.list_objects_v2(Bucket='gallery').get('Contents', []))
+
+    def test_sync(self):
+        uploaded, deleted = self._sync()
+        self.assertEqual(sorted(uploaded), sorted(self.files))
+        self.assertEqual(self._keys(), sorted(self.files))
+        self.assertTrue(Path(self.root, BeHappySync.MANIFEST).exists())
+        # Same sizes and ETags, multipart video included
+        self.assertEqual(self._sync(), ([], []))
+
+    def test_manifest_version(self):
+        self._sync()
+        with patch.object(BeHappySync, 'MULTIPART_CHUNKSIZE', 5 * self.MB):
+            sync = BeHappySync(self.root, None, None, 'gallery')
+            self.assertIn('index.html', sync._load_manifest())
+            with patch.object(BeHappySync, 'MANIFEST_VERSION', BeHappySync.MANIFEST_VERSION + 1):
+                self.assertEqual(sync._load_manifest(), {})
+
+    def test_media_first(self):
+        with patch.object(BeHappySync, 'MULTIPART_CHUNKSIZE', 5 * self.MB):
+            sync = BeHappySync(self.root, None, None, 'gallery')
+            with patch.object(sync, '_s3_upload') as upload:
+                sync.s3()
+        uploaded = [i.args[0] for i in upload.call_args_list]
+        media = ['album/a1/small/1.jpg', 'album/a1/small/1.webp', 'album/a1/video/1.mp4']
+        self.assertEqual(sorted(uploaded[:3]), media)
+        self.assertEqual(sorted(uploaded[3:]), sorted(set(self.files) - set(media)))
+
+    def test_changed_and_removed(self):
+        self._sync()
+        Path(self.root, 'index.html').write_bytes(b'<html>changed</html>')
+        Path(self.root, 'css/style.css').unlink()
+        self.assertEqual(self._sync(), (['index.html'], ['css/style.css']))
+        self.assertNotIn('css/style.css', self._keys())
+        page = self.s3.get_object(Bucket='gallery', Key='index.html')
+        self.assertEqual(gzip.decompress(page['Body'].read()), b'<html>changed</html>')
+        self.assertEqual((page['ContentEncoding'], page['CacheControl']), ('gzip', 'public, max-age=300'))
+
+    def test_delete_errors(self):
+        self._sync()
+        Path(self.root, 'css/style.css').unlink()
+        errors = {'Errors': [{'Key': 'css/style.css', 'Code': 'AccessDenied', 'Message': 'Access Denied'}]}
+        with patch.object(BeHappySync, 'MULTIPART_CHUNKSIZE', 5 * self.MB), \
+                patch('sys.stdout', new_callable=io.StringIO) as out:
+            sync = BeHappySync(self.root, None, None, 'gallery')
+            with patch.object(sync._s3, 'delete_objects', return_value=errors):
+                with self.assertRaises(Exception):
+                    sync.s3()
+        self.assertIn('\tcss/style.css AccessDenied Access Denied\n', out.getvalue())
+
+    def test_headers_changed(self):
+        self._sync()
+        image = self.s3.head_object(Bucket='gallery', Key='album/a1/small/1.jpg')
+        self.assertEqual(image['CacheControl'], 'public, max-age=31536000, immutable')
+        options = [HeaderOptions(['*.jpg'], cache_control='no-cache'),
+                   HeaderOptions(['*.html', 'css/*'], encoding='gzip')]
+        with patch.object(BeHappySync, 'MULTIPART_CHUNKSIZE', 5 * self.MB):
+            sync = BeHappySync(self.root, None, None, 'gallery', header_options=options)
+            with patch.object(sync, '_s3_upload') as upload:
+                uploaded, _ = sync.s3()
+                upload.assert_not_called()
+        self.assertIn('album/a1/small/1.jpg', uploaded)
+        image = self.s3.head_object(Bucket='gallery', Key='album/a1/small/1.jpg')
+        self.assertEqual((image['CacheControl'], image['ContentType']), ('no-cache', 'image/jpeg'))
+
+    def test_remote_drift(self):
+        self._sync()
+        self.s3.put_object(Bucket='gallery', Key='index.html', Body=b'other')
+        self.s3.put_object(Bucket='gallery', Key='old.html', Body=b'old')
+        self.assertEqual(self._sync(), (['index.html'], ['old.html']))
+
+    def test_invalidation_paths(self):
+        sync = BeHappySync(self.root, None, None, 'gallery')
+        keys = ['index.html', 'album/a1/index.html'] + ['album/a2/small/{}.jpg'.format(i) for i in range(20)]
+        paths = sync._invalidation_paths(keys)
+        self.assertEqual(sorted(paths), ['/', '/album/a1/', '/album/a1/index.html', '/album/a2/small/*', '/index.html'])
+        with patch.object(sync._cloudfront, 'create_invalidation') as create:
+            sync.cloudfront_invalidate('E1', keys, dry_run=True)
+            create.assert_not_called()
+
+    def test_invalidation_batches(self):
+        sync = BeHappySync(self.root, None, None, 'gallery')
+        paths = ['/{}/*'.format(i) for i in range(20)] + ['/{}.html'.format(i) for i in range(4000)]
+        batches = sync._invalidation_batches(paths)
+        self.assertEqual([len(i) for i in batches], [15, 3000, 1005])
+        self.assertTrue(all(sum(j.endswith('*') for j in i) <= 15 for i in batches))
+
+    def test_sidecars(self):
+        write_sidecar(Path(self.root, 'index.html'), 'gzip')
+        uploaded, _ = self._sync()
+        self.assertNotIn('index.html.gz', self._keys())
+        page = self.s3.get_object(Bucket='gallery', Key='index.html')
+        self.assertEqual(page['Body'].read(), Path(self.root, 'index.html.gz').read_bytes())
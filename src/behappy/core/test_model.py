@@ -0,0 +1,88 @@
+import gc
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch, Mock
+
+from click.testing import CliRunner
+
+from behappy.core.conf import settings
+from behappy.core.model import Image, Album, ImageSet
+from benchmarks import model_memory
+
+
+class TestImage(TestCase):
+
+    def setUp(self):
+        self.addCleanup(settings.restore, settings.snapshot())
+        settings.load(Path(__file__).parent.parent.parent / 'samples' / 'behappy.gallery.ini')
+
+    def test_rendition(self):
+        image = Image(Path('/photos/a.jpg'), hash='ab' * 32, orientation=6)
+        for option in settings.image_variants():
+            self.assertEqual(image.rendition(option.key), image._cache_name(option))
+        self.assertEqual(len(set(image.rendition(i.key) for i in settings.image_variants())),
+                         len(settings.image_variants()))
+        option = settings.image_options()['small']
+        self.assertEqual(image.uri('a1', 'small').name, image._cache_name(option) + '.jpg')
+
+    def test_memory_benchmark(self):
+        result = CliRunner().invoke(model_memory.main, ['--count', '10', '--album-size', '5'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('10 images', result.output)
+
+
+class TestAlbum(TestCase):
+
+    def setUp(self):
+        self.addCleanup(settings.restore, settings.snapshot())
+        settings.load(Path(__file__).parent.parent.parent / 'samples' / 'behappy.gallery.ini')
+
+    def _album(self, page_size):
+        return Album('a1', None, 'A1', '', '2020-01-01', '', False, Path('/photos/a1'), None, None, page_size=page_size)
+
+    def test_pages(self):
+        album = self._album(page_size=3)
+        self.assertEqual(album.pages([]), [[]])
+        self.assertEqual(album.pages([1, 2, 3]), [[1, 2, 3]])
+        self.assertEqual(album.pages([1, 2, 3, 4]), [[1, 2, 3], [4]])
+        self.assertEqual(album.pages(list(range(7))), [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual(self._album(page_size=0).pages([1, 2, 3, 4]), [[1, 2, 3, 4]])
+        self.assertEqual(album.page_uri(1), '/album/a1/')
+        self.assertEqual(album.page_uri(2), '/album/a1/page/2/')
+        with self.assertRaises(Exception):
+            self._album(page_size=-1)
+
+
+class TestImageSet(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_unreadable_thumbnail(self):
+        Path(self.root, 'cover.png').write_bytes(b'broken')
+        cache = Mock(load_items=Mock(return_value=([], [])))
+        image_set = ImageSet(self.root, 'cover.png', '*.jpg', '', 'date', cache)
+        with patch('behappy.core.model.read_exif', return_value=[]), \
+                self.assertLogs('behappy.core.model', 'WARNING'):
+            self.assertIsNone(image_set.thumbnail)
+
+    def _alive(self):
+        return sum(isinstance(i, ImageSet) for i in gc.get_objects())
+
+    def test_release(self):
+        gc.collect()
+        alive = self._alive()
+        Path(self.root, '0.jpg').write_bytes(b'photo')
+        cache = Mock(load_items=Mock(return_value=([], [])))
+        image_set = ImageSet(self.root, None, '*.jpg', '', 'date', cache)
+        with patch('behappy.core.model.read_exif', return_value=[]), patch('behappy.core.model.hasher'):
+            self.assertEqual(image_set.images(), [])
+        self.assertEqual(image_set._images(), {Path(self.root, '0.jpg').absolute()})
+        del image_set
+        gc.collect()
+        self.assertEqual(self._alive(), alive)
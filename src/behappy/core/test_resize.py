@@ -0,0 +1,129 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from PIL import Image
+
+from behappy.core.resize import ImageResizer, ResizeOptions, BetterImage
+
+
+class TestImageResizer(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.source = Path(self.root, 'source.jpg')
+        Image.new('RGB', (3000, 2000), color=(120, 60, 30)).save(self.source, 'JPEG')
+        self.small = ResizeOptions(width=300, height=300, crop=True, name='small')
+        self.big = ResizeOptions(width=1200, height=800, name='big')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _size(self, path):
+        with Image.open(path) as img:
+            return img.size
+
+    def test_resize_all(self):
+        renditions = [(Path(self.root, 'small.jpg'), self.small), (Path(self.root, 'big.jpg'), self.big)]
+        with patch('behappy.core.resize.Image.open', wraps=Image.open) as open_mock:
+            written = ImageResizer().resize_all(self.source, renditions, orientation=0)
+
+        self.assertEqual(written.written, 2)
+        self.assertEqual(open_mock.call_count, 1)
+        self.assertEqual(self._size(Path(self.root, 'small.jpg')), (300, 300))
+        self.assertEqual(self._size(Path(self.root, 'big.jpg')), (1200, 800))
+
+    def test_resize_all_skip_existing(self):
+        renditions = [(Path(self.root, 'small.jpg'), self.small), (Path(self.root, 'big.jpg'), self.big)]
+        ImageResizer().resize(self.source, Path(self.root, 'big.jpg'), self.big, orientation=0)
+
+        self.assertEqual(ImageResizer().resize_all(self.source, renditions, orientation=0).written, 1)
+        self.assertEqual(ImageResizer().resize_all(self.source, renditions, orientation=0).written, 0)
+
+    def test_resize_formats(self):
+        small = ResizeOptions(width=300, height=300, crop=True, formats=['webp'], widths=[150], name='small')
+        renditions = [(Path(self.root, '{}-{}.{}'.format(i.name, i.width, i.extension)), i) for i in small.variants()]
+        with patch('behappy.core.resize.BetterImage.resize', autospec=True,
+                   side_effect=BetterImage.resize) as resize_mock:
+            written = ImageResizer().resize_all(self.source, renditions, orientation=0)
+
+        self.assertEqual(written.written, 4)
+        self.assertEqual(resize_mock.call_count, 2)
+        with Image.open(Path(self.root, 'small-150.webp')) as img:
+            self.assertEqual((img.format, img.size), ('WEBP', (150, 150)))
+        self.assertEqual(self._size(Path(self.root, 'small-300.jpg')), (300, 300))
+
+    def test_unsupported_format(self):
+        save = {k: v for k, v in Image.SAVE.items() if k != 'AVIF'}
+        with patch.dict(Image.SAVE, save, clear=True), self.assertLogs('behappy.core.resize', 'WARNING'):
+            option = ResizeOptions(width=300, height=300, formats=['avif', 'webp'], name='small')
+            self.assertEqual(option.formats, ('webp',))
+            with self.assertRaises(Exception):
+                ResizeOptions(width=300, height=300, format='avif', name='small')
+
+    def test_resize_strip(self):
+        source = Path(self.root, 'exif.jpg')
+        exif = Image.Exif()
+        exif[0x010f] = 'Camera'
+        Image.new('RGB', (600, 400), color=(120, 60, 30)).save(source, 'JPEG', quality=100, exif=exif,
+                                                               icc_profile=b'profile')
+        big = ResizeOptions(width=1200, height=800, progressive=True, optimize=True, subsampling='4:2:0', strip=True,
+                            name='big')
+        to_path = Path(self.root, 'big.jpg')
+        stats = ImageResizer().resize_all(source, [(to_path, big)], orientation=0)
+
+        self.assertEqual(stats.saved, source.stat().st_size - to_path.stat().st_size)
+        self.assertGreater(stats.saved, 0)
+        with Image.open(to_path) as img:
+            self.assertEqual(img.info.get('icc_profile'), b'profile')
+            self.assertNotIn('exif', img.info)
+            self.assertTrue(img.info.get('progressive'))
+
+    def test_resize_strip_bigger(self):
+        source = Path(self.root, 'noise.jpg')
+        Image.effect_noise((600, 400), 64).convert('RGB').save(source, 'JPEG', quality=80)
+        big = ResizeOptions(width=1200, height=800, quality=100, subsampling='4:4:4', strip=True, name='big')
+        to_path = Path(self.root, 'big.jpg')
+        stats = ImageResizer().resize_all(source, [(to_path, big)], orientation=0)
+
+        self.assertGreater(to_path.stat().st_size, source.stat().st_size)
+        self.assertEqual(stats.saved, 0)
+
+    def test_resize_copy_threshold(self):
+        source = Path(self.root, 'small.jpg')
+        Image.new('RGB', (600, 400), color=(120, 60, 30)).save(source, 'JPEG', quality=100)
+        copy = ResizeOptions(width=1200, height=800, reencode_above=source.stat().st_size, name='big')
+        ImageResizer().resize(source, Path(self.root, 'copy.jpg'), copy, orientation=0)
+        encode = ResizeOptions(width=1200, height=800, reencode_above=0, name='big')
+        stats = ImageResizer().resize_all(source, [(Path(self.root, 'encode.jpg'), encode)], orientation=0)
+
+        self.assertEqual(Path(self.root, 'copy.jpg').read_bytes(), source.read_bytes())
+        self.assertGreater(stats.saved, 0)
+
+    def test_describe(self):
+        renditions = [(Path(self.root, 'small.jpg'), self.small), (Path(self.root, 'big.jpg'), self.big)]
+        ImageResizer().resize_all(self.source, renditions, orientation=0)
+        placeholder, sizes = ImageResizer().describe([i for i, _ in renditions])
+
+        self.assertEqual(sizes, {'small': (300, 300), 'big': (1200, 800)})
+        self.assertTrue(placeholder.startswith('data:image/webp;base64,'))
+        self.assertLess(len(placeholder), 300)
+
+    def test_resize_rotate(self):
+        to_path = Path(self.root, 'big.jpg')
+        ImageResizer().resize(self.source, to_path, self.big, orientation=90)
+
+        self.assertEqual(self._size(to_path), (800, 1200))
+
+    def test_resize_draft(self):
+        fast = ResizeOptions(width=300, height=300, crop=True, speed='fast', name='small')
+        quality = ResizeOptions(width=300, height=300, crop=True, speed='quality', name='small')
+        with patch('behappy.core.resize.BetterImage.draft') as draft_mock:
+            ImageResizer().resize(self.source, Path(self.root, 'fast.jpg'), fast, orientation=0)
+            ImageResizer().resize(self.source, Path(self.root, 'quality.jpg'), quality, orientation=0)
+
+        draft_mock.assert_called_once_with(450, 300)
+        self.assertEqual(self._size(Path(self.root, 'fast.jpg')), (300, 300))
+        self.assertEqual(self._size(Path(self.root, 'quality.jpg')), (300, 300))
@@ -0,0 +1,58 @@
+import os
+import re
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from behappy.core.scan import DirectoryScanner
+
+
+class TestDirectoryScanner(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.cache = Path(self.root, 'scan.json')
+        self.source = Path(self.root, 'source')
+        for path in ['a1/behappy.ini', 'a1/1.jpg', 'a1/raw/2.jpg', 'a2/behappy.ini', '@eaDir/behappy.ini']:
+            Path(self.source, path).parent.mkdir(parents=True, exist_ok=True)
+            Path(self.source, path).touch()
+        # Make folders older than racy window to be reused
+        for folder, _, _ in os.walk(self.source):
+            os.utime(folder, ns=(0, 10 ** 9))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _scanner(self):
+        scanner = DirectoryScanner(self.cache, ['@eaDir'])
+        scanner.scan([self.source])
+        scanner.save()
+        return scanner
+
+    def test_search(self):
+        found = self._scanner().search(re.compile(r'^behappy\.ini$'))
+        self.assertEqual(sorted(found), [Path(self.source, 'a1/behappy.ini'), Path(self.source, 'a2/behappy.ini')])
+
+    def test_glob(self):
+        scanner = self._scanner()
+        folder = Path(self.source, 'a1')
+        self.assertEqual(scanner.glob(folder, '*.jpg'), [Path(folder, '1.jpg')])
+        self.assertEqual(sorted(scanner.glob(folder, '**/*.jpg')), sorted(folder.glob('**/*.jpg')))
+        self.assertIsNone(scanner.glob(Path(self.root, 'other'), '*.jpg'))
+        self.assertIsNone(scanner.glob(folder, '../*.jpg'))
+
+    def test_reuse(self):
+        self.assertEqual(self._scanner().listed, 4)
+        Path(self.source, 'a2/3.jpg').touch()
+        os.utime(Path(self.source, 'a2'), ns=(0, 2 * 10 ** 9))
+        scanner = self._scanner()
+        self.assertEqual((scanner.listed, scanner.reused), (1, 3))
+        self.assertEqual(scanner.glob(Path(self.source, 'a2'), '*.jpg'), [Path(self.source, 'a2/3.jpg')])
+
+    def test_rescan(self):
+        scanner = self._scanner()
+        self.assertEqual(scanner.rescan([self.source]), [])
+        Path(self.source, 'a1/raw/3.jpg').touch()
+        self.assertEqual(scanner.rescan([self.source]), [Path(self.source, 'a1/raw')])
+        self.assertEqual(scanner.rescan([self.source]), [])
@@ -0,0 +1,64 @@
+import gzip
+import http.client
+import threading
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from behappy.core.headers import write_sidecar
+from behappy.core.server import create_server
+
+
+class TestGalleryRequestHandler(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.video = Path(self.root, 'album', 'a1', 'video', '{}.mp4'.format('a' * 64))
+        self.video.parent.mkdir(parents=True)
+        self.video.write_bytes(bytes(range(256)) * 4)
+        Path(self.root, 'index.html').write_bytes(b'<html></html>')
+        Path(self.root, '.behappy.pages.json').write_bytes(b'{}')
+        self.server = create_server(self.tmp.name, 0, host='127.0.0.1')
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def _get(self, path, **headers):
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.server_address[1])
+        connection.request('GET', path, headers=headers)
+        response = connection.getresponse()
+        body = response.read()
+        connection.close()
+        return response, body
+
+    def test_range(self):
+        path = '/album/a1/video/{}'.format(self.video.name)
+        response, body = self._get(path, Range='bytes=10-19')
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.getheader('Content-Range'), 'bytes 10-19/1024')
+        self.assertEqual(body, bytes(range(10, 20)))
+        response, body = self._get(path, Range='bytes=-4')
+        self.assertEqual(body, bytes(range(252, 256)))
+        response, _ = self._get(path, Range='bytes=2000-')
+        self.assertEqual(response.status, 416)
+
+    def test_etag(self):
+        path = '/album/a1/video/{}'.format(self.video.name)
+        response, _ = self._get(path)
+        self.assertEqual(response.getheader('ETag'), '"{}"'.format('a' * 64))
+        response, body = self._get(path, **{'If-None-Match': '"{}"'.format('a' * 64)})
+        self.assertEqual((response.status, body), (304, b''))
+
+    def test_sidecar(self):
+        write_sidecar(Path(self.root, 'index.html'), 'gzip')
+        response, body = self._get('/', **{'Accept-Encoding': 'br;q=0, gzip'})
+        self.assertEqual(response.getheader('Content-Encoding'), 'gzip')
+        self.assertEqual(gzip.decompress(body), b'<html></html>')
+        response, body = self._get('/')
+        self.assertEqual((response.getheader('Content-Encoding'), body), (None, b'<html></html>'))
+        response, _ = self._get('/.behappy.pages.json')
+        self.assertEqual(response.status, 404)
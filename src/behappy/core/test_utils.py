@@ -1,9 +1,18 @@
+import hashlib
+import os
+import sys
 from datetime import datetime
 from pathlib import Path
+from tempfile import TemporaryDirectory
 from unittest import TestCase
+from unittest.mock import patch
 from urllib.request import urlretrieve
 
-from behappy.core.utils import parse_orientation, read_exif
+import orjson
+
+from behappy.core.model import Image
+from behappy.core.utils import parse_orientation, read_exif, ExifTool, MetadataStore, atomic_file, \
+    remove_temp_files, CacheManager, ContentHasher
 
 
 class TestUtils(TestCase):
@@ -45,3 +54,228 @@ class TestUtils(TestCase):
         _, exif = read_exif([Path(self.test_img1)])[0]
 
         self.assertEqual(exif.info(), 'Fujifilm X-T30  XF35mmF2 R WR | ISO320  f/2.0  1/420s | Astia | image-01')
+
+class TestExifTool(TestCase):
+    """
+    Runs against a stand-in of `exiftool -stay_open`, that knows only file names
+    """
+    SCRIPT = """import json, os, sys
+args = []
+for line in sys.stdin:
+    line = line.rstrip('\\n')
+    if line.startswith('-execute'):
+        files = [i for i in args if not i.startswith('-') and os.path.exists(i)]
+        if files:
+            print(json.dumps([{'SourceFile': i, 'File:FileName': os.path.basename(i)} for i in files]))
+        print('{ready%s}' % line[len('-execute'):], flush=True)
+        args = []
+    elif line == 'False' and args[-1:] == ['-stay_open']:
+        break
+    else:
+        args.append(line)
+"""
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.executable = Path(self.root, 'exiftool')
+        self.executable.write_text('#!{}\n{}'.format(sys.executable, self.SCRIPT))
+        self.executable.chmod(0o755)
+        self.paths = [Path(self.root, 'a.jpg'), Path(self.root, 'b.jpg')]
+        for path in self.paths:
+            path.write_bytes(b'jpeg')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_restart(self):
+        session = ExifTool(self.executable.as_posix())
+        try:
+            self.assertEqual(len(session.read(self.paths[:1])), 1)
+            crashed = session._process
+            crashed.kill()
+            crashed.wait()
+            self.assertEqual(len(session.read(self.paths[:1])), 1)
+            self.assertTrue(crashed.stdout.closed)
+        finally:
+            session.close()
+        self.assertFalse(session.running)
+
+    def test_skip_unreadable(self):
+        self.paths[0].unlink()
+        session = ExifTool(self.executable.as_posix())
+        try:
+            with self.assertLogs('behappy.core.utils', level='WARNING') as logs:
+                result = session.read(self.paths)
+            self.assertEqual([i['SourceFile'] for i in result], [self.paths[1].as_posix()])
+            self.assertIn(self.paths[0].as_posix(), logs.output[0])
+            self.assertTrue(session.running)
+            process = session._process
+        finally:
+            session.close()
+        self.assertTrue(process.stdin.closed and process.stdout.closed)
+
+
+class TestContentHasher(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.path = Path(self.tmp.name, 'video.mp4')
+        self.content = os.urandom(10 * 1024 + 7)
+        self.path.write_bytes(self.content)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_hash(self):
+        # Digest of previous versions, that read whole file at once
+        expected = hashlib.blake2b(self.content).hexdigest()
+        with patch.object(ContentHasher, 'CHUNK_SIZE', 1024):
+            self.assertEqual(ContentHasher().hash(self.path), expected)
+            with patch.object(ContentHasher, 'MMAP_THRESHOLD', 1024):
+                self.assertEqual(ContentHasher().hash(self.path), expected)
+        hasher = ContentHasher(size=2)
+        self.assertEqual([i.result() for i in hasher.submit([self.path, self.path])], [expected, expected])
+        hasher.close()
+
+    def _edit(self, offset):
+        content = bytearray(self.content)
+        content[offset] ^= 0xFF
+        self.path.write_bytes(content)
+
+    @patch.object(ContentHasher, 'SAMPLE_SIZE', 1024)
+    def test_fingerprint(self):
+        fingerprint = ContentHasher().fingerprint(self.path)
+        self.assertNotEqual(fingerprint, ContentHasher().hash(self.path))
+        for offset in (0, len(self.content) - 1, len(self.content) // 2):
+            self._edit(offset)
+            self.assertNotEqual(ContentHasher().fingerprint(self.path), fingerprint, offset)
+        # Changes between samples are seen only by `hash`, see `behappy verify`
+        self._edit(2000)
+        self.assertEqual(ContentHasher().fingerprint(self.path), fingerprint)
+        self.path.write_bytes(self.content + b'0')
+        self.assertNotEqual(ContentHasher().fingerprint(self.path), fingerprint)
+
+
+class TestCacheManager(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.ini = Path(self.root, 'behappy.ini')
+        self.paths = [Path(self.root, i) for i in ('a.jpg', 'b.jpg', 'c.jpg')]
+        for path in self.paths:
+            path.write_bytes(path.name.encode())
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _image(self, path):
+        return Image(path, date=datetime(2020, 1, 1), orientation=0, exif_info=path.name,
+                     stamp=Image.make_stamp(path), hash=path.name.encode().hex())
+
+    def test_load_items(self):
+        CacheManager(self.ini, 'test').save_list('images', [self._image(i) for i in self.paths[:2]])
+        self.paths[1].write_bytes(b'changed')
+
+        values, missing = CacheManager(self.ini, 'test').load_items('images', Image, self.paths)
+        self.assertEqual([i.path for i in values], self.paths[:1])
+        self.assertEqual(values[0].exif_info, 'a.jpg')
+        self.assertEqual(missing, self.paths[1:])
+
+    def test_save_list_only_on_change(self):
+        images = [self._image(i) for i in self.paths]
+        CacheManager(self.ini, 'test').save_list('images', images)
+        cache = self.ini.with_suffix('.cache.json')
+        mtime = cache.stat().st_mtime_ns
+
+        CacheManager(self.ini, 'test').save_list('images', images)
+        self.assertEqual(cache.stat().st_mtime_ns, mtime)
+        CacheManager(self.ini, 'test').save_list('images', images[:1])
+        self.assertEqual([i['path'] for i in orjson.loads(cache.read_bytes())['images']], [self.paths[0].as_posix()])
+
+
+class TestMetadataStore(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.ini = Path(self.root, 'behappy.ini')
+        self.images = []
+        for name in ('a.jpg', 'b.jpg'):
+            path = Path(self.root, name)
+            path.write_bytes(name.encode())
+            self.images.append(Image(path, date=datetime(2020, 1, 1), orientation=0, exif_info=name,
+                                     stamp=Image.make_stamp(path), hash=name.encode().hex()))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_save_and_prune(self):
+        store = MetadataStore(Path(self.root, 'cache', '.behappy.sqlite'))
+        store.manager(self.ini, 'test').save_list('images', self.images)
+
+        values, missing = store.manager(self.ini, 'test').load_items('images', Image, [i.path for i in self.images])
+        self.assertEqual(sorted(i.exif_info for i in values), ['a.jpg', 'b.jpg'])
+        self.assertEqual(missing, [])
+
+        store.manager(self.ini, 'test').save_list('images', self.images[:1])
+        self.assertEqual(len(store.load(self.ini.as_posix(), 'images')), 1)
+        store.close()
+
+    def test_update_items(self):
+        store = MetadataStore(Path(self.root, '.behappy.sqlite'))
+        store.manager(self.ini, 'test').save_list('images', self.images)
+        self.images[0].set_preview('data:image/webp;base64,AA==', {'abc': (960, 640)})
+        store.manager(self.ini, 'test').update_items('images', self.images[:1])
+
+        values, _ = store.manager(self.ini, 'test').load_items('images', Image, [self.images[0].path])
+        self.assertEqual(values[0].placeholder, 'data:image/webp;base64,AA==')
+        self.assertEqual(values[0].serialize()['dimensions'], {'abc': [960, 640]})
+        store.close()
+
+    def test_import_json(self):
+        state = {'images': [i.serialize() for i in self.images]}
+        self.ini.with_suffix('.cache.json').write_bytes(orjson.dumps(state))
+        store = MetadataStore(Path(self.root, '.behappy.sqlite'))
+
+        values, missing = store.manager(self.ini, 'test').load_items('images', Image, [i.path for i in self.images])
+        self.assertEqual(len(values), 2)
+        self.assertEqual(missing, [])
+        store.close()
+
+
+class TestAtomicFile(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_interrupted(self):
+        path = Path(self.root, 'album', 'small', 'a.jpg')
+        with self.assertRaises(KeyboardInterrupt):
+            with atomic_file(path, fsync=True) as tmp:
+                tmp.write_bytes(b'half')
+                raise KeyboardInterrupt()
+        self.assertEqual(list(path.parent.iterdir()), [])
+
+        with atomic_file(path, fsync=True) as tmp:
+            tmp.write_bytes(b'full')
+        self.assertEqual(path.read_bytes(), b'full')
+
+    def test_remove_temp_files(self):
+        path = Path(self.root, 'album', 'small', 'a.jpg')
+        with self.assertRaises(KeyboardInterrupt):
+            with atomic_file(path) as tmp:
+                # Killed process has no chance to clean up
+                tmp.write_bytes(b'half')
+                tmp.rename(Path(self.root, 'album', tmp.name))
+                raise KeyboardInterrupt()
+        Path(self.root, '.hidden.tmp').write_bytes(b'')
+
+        self.assertEqual(remove_temp_files([self.root]), 0)
+        self.assertEqual(remove_temp_files([self.root, Path(self.root, 'album'), Path(self.root, 'missing')]), 1)
+        self.assertEqual(sorted(i.name for i in self.root.rglob('*') if i.is_file()), ['.hidden.tmp'])
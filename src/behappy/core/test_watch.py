@@ -0,0 +1,41 @@
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from behappy.core.watch import SourceWatcher
+
+
+class TestSourceWatcher(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.photo = Path(self.root, 'a1', '0.jpg')
+        self.photo.parent.mkdir()
+        self.photo.write_bytes(b'photo')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    @patch('behappy.core.watch.Observer', None)
+    def test_polling(self):
+        watcher = SourceWatcher([self.root], interval=0)
+        watcher.start()
+        self.assertEqual(watcher.backend, 'polling')
+        self.assertEqual(watcher.wait(), set())
+
+        # Edit in place keeps the folder listing, it is found by the next check of all files
+        self.photo.write_bytes(b'edited photo')
+        os.utime(self.photo, ns=(0, 10 ** 9))
+        Path(self.root, 'a1', 'a1.cache.json').write_text('{}')
+        self.assertEqual(watcher.wait(), set())
+        with patch.object(watcher, 'FULL_CHECK', 0):
+            self.assertEqual(watcher.wait(), {self.photo})
+
+        added = Path(self.root, 'a1', '1.jpg')
+        added.write_bytes(b'photo')
+        self.photo.unlink()
+        self.assertEqual(watcher.wait(), {self.photo, added})
+        watcher.close()
@@ -1,18 +1,28 @@
 # -*- coding: utf-8 -*-
+import atexit
 import functools
 import hashlib
 import inspect
+import logging
+import mmap
 import os
+import queue
 import re
+import sqlite3
 import subprocess
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
-from time import time_ns
+from time import time_ns, monotonic
 from typing import List
 
 import orjson
 
+logger = logging.getLogger(__name__)
+
 
 def timeit(f):
     msg = '## {0} complete in {1:.0f} min {2:.1f} sec ({3}ns)'
@@ -51,16 +61,6 @@ def memoize(func):
     return memoized_func
 
 
-def search_files(paths: List[Path], pattern: re.Pattern):
-    results = []
-    for path in paths:
-        for root, dirs, files in os.walk(path):
-            for f in files:
-                if pattern.match(f):
-                    results.append(Path(root, f))
-    return results
-
-
 def all_files(path: Path):
     results = []
     for root, dirs, files in os.walk(path):
@@ -70,6 +70,74 @@ def all_files(path: Path):
     return results
 
 
+def write_if_changed(path: Path, content: bytes, fsync=False):
+    """
+    Write `content` only if file is missing or differs, to keep its mtime.
+    """
+    if path.exists() and path.stat().st_size == len(content) and path.read_bytes() == content:
+        return False
+    atomic_write(path, content, fsync)
+    return True
+
+
+# Name of temporary file of `atomic_file`
+TEMP_FILE = re.compile(r'^\..+\.[0-9a-f]{32}\.tmp$')
+
+
+@contextmanager
+def atomic_file(path: Path, fsync=False):
+    """
+    Temporary path near `path` to write to. It is renamed to `path` on success and removed on error,
+    so `path` either does not exist or is complete, even if process is killed.
+    With `fsync` file and rename are flushed to disk and survive power loss too.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name('.{}.{}.tmp'.format(path.name, uid()))
+    try:
+        yield tmp
+        if fsync:
+            _fsync(tmp, os.O_RDONLY)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    if fsync and os.name == 'posix':
+        _fsync(path.parent, os.O_RDONLY | os.O_DIRECTORY)
+
+
+def _fsync(path: Path, flags):
+    fd = os.open(path, flags)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path: Path, content: bytes, fsync=False):
+    """
+    Write `content` to temporary file near `path` and rename it, readers never see partial file.
+    """
+    with atomic_file(path, fsync) as tmp:
+        tmp.write_bytes(content)
+
+
+def remove_temp_files(folders: List[Path]):
+    """
+    Remove temporary files left in `folders` by killed builds, subfolders are not walked. Return their count
+    """
+    removed = 0
+    for folder in set(folders):
+        try:
+            with os.scandir(folder) as it:
+                names = [i.name for i in it if TEMP_FILE.match(i.name)]
+        except FileNotFoundError:
+            continue
+        for name in names:
+            Path(folder, name).unlink(missing_ok=True)
+            removed += 1
+    return removed
+
+
 def parse_orientation(value):
     name2angle = {
         'Rotate 180': 180,  # N3
@@ -160,32 +228,383 @@ class CacheManager:
         else:
             self._state = {}
 
-    def load_list(self, key: str, factory, verification):
-        cache = self._state.get(key)
-        if not cache:
-            if verification:
-                print(f'[{self.name}] Empty cache {key}')
-            return []
-        current = sorted([factory.make_stamp(i) for i in verification])
-        saved = sorted([i['stamp'] for i in cache])
-        if current == saved:
-            return [factory.deserialize(i) for i in cache]
-        print(f'[{self.name}] Skip cache {key}')
-        return []
+    def load_items(self, key: str, factory, paths):
+        """
+        Return cached values for `paths` which stamps are not changed,
+        and list of new or changed paths which need to be read again.
+        """
+        cache = {i['path']: i for i in self._items(key)}
+        values = []
+        missing = []
+        for path in paths:
+            item = cache.pop(path.absolute().as_posix(), None)
+            if item and item['stamp'] == factory.make_stamp(path):
+                values.append(factory.deserialize(item))
+            else:
+                missing.append(path)
+        if missing or cache:
+            print(f'[{self.name}] Update cache {key}: {len(missing)} new or changed, {len(cache)} removed')
+        return values, missing
 
     def save_list(self, key: str, values):
-        self._state[key] = [i.serialize() for i in values]
-        self.path.write_bytes(orjson.dumps(self._state))
+        """
+        Save `values`, entries of the removed files are dropped. File is written only on change.
+        """
+        saved = set((i['path'], i['stamp']) for i in self._items(key))
+        state = [i.serialize() for i in values]
+        if saved != set((i['path'], i['stamp']) for i in state) or len(saved) != len(state):
+            self._write(key, state)
+
+    def update_items(self, key: str, values):
+        """
+        Replace entries of `values` which stamps are not changed, such as fields computed after reading
+        """
+        if not values:
+            return
+        updated = {i['path']: i for i in (i.serialize() for i in values)}
+        self._write(key, [updated.pop(i['path'], i) for i in self._items(key)])
+
+    def _items(self, key: str):
+        return self._state.get(key, [])
+
+    def _write(self, key: str, items):
+        self._state[key] = items
+        atomic_write(self.path, orjson.dumps(self._state))
+
+
+class MetadataStore:
+    """
+    Gallery-wide metadata cache in SQLite (WAL mode), instead of `.cache.json` files near the sources.
+    Albums are identified by path of their ini file.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path.as_posix(), check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS items ('
+                         'album TEXT NOT NULL, key TEXT NOT NULL, path TEXT NOT NULL, stamp TEXT NOT NULL, '
+                         'value BLOB NOT NULL, PRIMARY KEY (album, key, path)) WITHOUT ROWID')
+
+    def manager(self, original_path: Path, name):
+        return StoreCacheManager(self, original_path, name)
+
+    def load(self, album: str, key: str):
+        with self._lock:
+            rows = self._db.execute('SELECT value FROM items WHERE album = ? AND key = ?', (album, key)).fetchall()
+        return [orjson.loads(i[0]) for i in rows]
+
+    def save(self, album: str, key: str, items, removed):
+        """
+        Replace `items` and delete `removed` paths in one transaction
+        """
+        rows = [(album, key, i['path'], i['stamp'], orjson.dumps(i)) for i in items]
+        with self._lock:
+            self._db.execute('BEGIN')
+            try:
+                self._db.executemany('DELETE FROM items WHERE album = ? AND key = ? AND path = ?',
+                                     [(album, key, i) for i in removed])
+                self._db.executemany('INSERT OR REPLACE INTO items (album, key, path, stamp, value) '
+                                     'VALUES (?, ?, ?, ?, ?)', rows)
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+
+    def has_album(self, album: str):
+        with self._lock:
+            row = self._db.execute('SELECT 1 FROM items WHERE album = ? LIMIT 1', (album,)).fetchone()
+        return row is not None
+
+    def import_json(self, original_path: Path):
+        """
+        Copy entries of the album `.cache.json` file if store knows nothing about this album yet
+        """
+        album = original_path.absolute().as_posix()
+        path = original_path.with_suffix('.cache.json')
+        if path.exists() and not self.has_album(album):
+            for key, items in orjson.loads(path.read_bytes()).items():
+                self.save(album, key, items, removed=[])
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class StoreCacheManager(CacheManager):
+    """
+    Same as `CacheManager` but keeps entries in the `MetadataStore`,
+    source folders are only read.
+    """
+
+    def __init__(self, store: MetadataStore, original_path: Path, name):
+        self.path = original_path
+        self.name = name
+        self._store = store
+        self._album = original_path.absolute().as_posix()
+        self._state = {}
+        store.import_json(original_path)
+
+    def _items(self, key: str):
+        if key not in self._state:
+            self._state[key] = self._store.load(self._album, key)
+        return self._state[key]
+
+    def update_items(self, key: str, values):
+        if not values:
+            return
+        updated = {i['path']: i for i in (i.serialize() for i in values)}
+        self._store.save(self._album, key, list(updated.values()), removed=[])
+        self._state[key] = [updated.get(i['path'], i) for i in self._items(key)]
+
+    def _write(self, key: str, items):
+        saved = dict((i['path'], i['stamp']) for i in self._items(key))
+        changed = [i for i in items if saved.pop(i['path'], None) != i['stamp']]
+        self._store.save(self._album, key, changed, removed=list(saved))
+        self._state[key] = items
+
+
+class ExifToolError(Exception):
+    pass
+
+
+class ExifTool:
+    """
+    Long-lived `exiftool -stay_open` process, reads arguments from stdin.
+    Not thread safe, use one session per thread.
+    """
+    COMMON_ARGS = ['-groupNames', '-json', '-quiet']
+
+    def __init__(self, executable='exiftool'):
+        self.executable = executable
+        self._process = None
+        self._counter = 0
+
+    @property
+    def running(self):
+        return self._process is not None and self._process.poll() is None
+
+    def start(self):
+        cmd = [self.executable, '-stay_open', 'True', '-@', '-', '-common_args'] + self.COMMON_ARGS
+        self._process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=subprocess.DEVNULL)
+
+    def close(self):
+        if self.running:
+            try:
+                self._process.stdin.write(b'-stay_open\nFalse\n')
+                self._process.stdin.close()
+                self._process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                self._process.kill()
+                self._process.wait()
+        if self._process is not None:
+            # Pipes of crashed process are left open too
+            for pipe in (self._process.stdin, self._process.stdout):
+                try:
+                    pipe.close()
+                except OSError:
+                    pass
+        self._process = None
+
+    def read(self, paths: List[Path]):
+        """
+        Return raw exif dicts for `paths`, restart process once if it is crashed.
+        """
+        try:
+            return self._read(paths)
+        except (OSError, ExifToolError):
+            if self.running:
+                raise
+            self.close()
+            return self._read(paths)
+
+    def _read(self, paths: List[Path]):
+        if not self.running:
+            self.close()
+            self.start()
+        self._counter += 1
+        ready = '{{ready{}}}'.format(self._counter).encode()
+        args = [os.fsencode(i.as_posix()) for i in paths] + [b'-execute%d' % self._counter]
+        self._process.stdin.write(b'\n'.join(args) + b'\n')
+        self._process.stdin.flush()
+        output = []
+        while True:
+            line = self._process.stdout.readline()
+            if not line:
+                raise ExifToolError('exiftool exited with code {}'.format(self._process.poll()))
+            if line.rstrip() == ready:
+                break
+            output.append(line)
+        result = orjson.loads(b''.join(output)) if output else []
+        if len(result) != len(paths):
+            # Unreadable or just deleted files are skipped
+            found = set(i['SourceFile'] for i in result)
+            missing = [i.as_posix() for i in paths if i.as_posix() not in found]
+            logger.warning('Cannot read exif of %s', ', '.join(missing))
+        return result
+
+
+class ExifToolPool:
+    """
+    Set of exiftool sessions shared by the whole build.
+    Big lists of paths are split into batches and read in parallel.
+    """
+    BATCH_SIZE = 64
+
+    def __init__(self, size=1):
+        self.size = size
+        self._lock = threading.Lock()
+        self._idle = queue.Queue()
+        self._sessions = []
+
+    def configure(self, size: int):
+        self.size = max(size, 1)
+
+    def read(self, paths: List[Path]):
+        batches = [paths[i:i + self.BATCH_SIZE] for i in range(0, len(paths), self.BATCH_SIZE)]
+        if len(batches) <= 1 or self.size == 1:
+            results = [self._read(i) for i in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=self.size) as executor:
+                results = list(executor.map(self._read, batches))
+        return [i for batch in results for i in batch]
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions = []
+            self._idle = queue.Queue()
+
+    def _read(self, paths: List[Path]):
+        session = self._acquire()
+        try:
+            return session.read(paths)
+        finally:
+            self._idle.put(session)
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle.empty() and len(self._sessions) < self.size:
+                session = ExifTool()
+                self._sessions.append(session)
+                return session
+        return self._idle.get()
+
+
+exiftool = ExifToolPool()
+atexit.register(exiftool.close)
 
 
 @memoize
 def read_exif(paths):
-    cmd = 'exiftool -groupNames -json -quiet'.split() + [i.as_posix() for i in paths]
-    output = subprocess.check_output(cmd)
-    exif = orjson.loads(output)
+    exif = exiftool.read(paths)
     return [(Path(i['SourceFile']), Exif(i)) for i in exif]
 
 
+class ContentHasher:
+    """
+    Streaming blake2b of file content, big files are hashed through mmap.
+    Hashing runs in a thread pool (hashlib releases GIL) and counts hashed bytes.
+    """
+    CHUNK_SIZE = 2 * 1024 * 1024
+    MMAP_THRESHOLD = 64 * 1024 * 1024
+    SAMPLE_SIZE = 1024 * 1024
+
+    def __init__(self, size=1):
+        self.size = size
+        self._lock = threading.Lock()
+        self._executor = None
+        self._files = 0
+        self._bytes = 0
+        self._started = None
+        self._finished = None
+
+    def configure(self, size: int):
+        self.size = max(size, 1)
+
+    def hash(self, path: Path) -> str:
+        started = monotonic()
+        h = hashlib.blake2b()
+        with path.open(mode='rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size >= self.MMAP_THRESHOLD:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    view = memoryview(m)
+                    for i in range(0, size, self.CHUNK_SIZE):
+                        h.update(view[i:i + self.CHUNK_SIZE])
+                    view.release()
+            else:
+                buffer = f.read(self.CHUNK_SIZE)
+                while buffer:
+                    h.update(buffer)
+                    buffer = f.read(self.CHUNK_SIZE)
+        self._count(size, started)
+        return h.hexdigest()
+
+    def fingerprint(self, path: Path) -> str:
+        """
+        Fast hash of file size with head, middle and tail samples, O(1) reads for any file size.
+        Small files are hashed fully.
+        """
+        started = monotonic()
+        h = hashlib.blake2b(b'sampled')
+        with path.open(mode='rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            h.update(str(size).encode())
+            sample = self.SAMPLE_SIZE
+            if size <= sample * 3:
+                offsets = [0]
+                sample = size
+            else:
+                offsets = [0, (size - sample) // 2, size - sample]
+            for offset in offsets:
+                f.seek(offset)
+                h.update(f.read(sample))
+        self._count(sample * len(offsets), started)
+        return h.hexdigest()
+
+    def submit(self, paths: List[Path], sampled=False):
+        """
+        Start hashing `paths` in background, return list of futures.
+        With `sampled` only fingerprint is calculated.
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.size)
+            executor = self._executor
+        func = self.fingerprint if sampled else self.hash
+        return [executor.submit(func, i) for i in paths]
+
+    def close(self):
+        with self._lock:
+            if self._executor:
+                self._executor.shutdown()
+            self._executor = None
+
+    def report(self):
+        if not self._files:
+            return 'Hashed 0 files'
+        mb = self._bytes / 1024 ** 2
+        elapsed = max(self._finished - self._started, 10 ** -6)
+        return 'Hashed {} files, {:.1f} MB in {:.1f} sec ({:.1f} MB/s)'.format(self._files, mb, elapsed, mb / elapsed)
+
+    def _count(self, size, started):
+        with self._lock:
+            self._files += 1
+            self._bytes += size
+            self._started = min(started, self._started or started)
+            self._finished = monotonic()
+
+
+hasher = ContentHasher()
+atexit.register(hasher.close)
+
+
 def file_stamp(version: int, path: Path) -> str:
     stat = path.stat()
     content = (version, stat.st_size, stat.st_ctime, stat.st_mtime,)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import queue
+import re
+import time
+from pathlib import Path
+from typing import List
+
+from behappy.core.scan import DirectoryScanner
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+
+class _EventHandler(FileSystemEventHandler):
+
+    def __init__(self, events: queue.Queue):
+        super().__init__()
+        self.events = events
+
+    def on_any_event(self, event):
+        # Reading sources by the build itself comes as opened and closed_no_write
+        if event.event_type not in ('created', 'deleted', 'modified', 'moved', 'closed'):
+            return
+        for path in (event.src_path, getattr(event, 'dest_path', None)):
+            if path and not SourceWatcher.ignored(Path(path)):
+                self.events.put(Path(path))
+
+
+class SourceWatcher:
+    """
+    Wait for changes in source folders.
+    Uses watchdog (inotify, FSEvents, ...) when it is installed, otherwise wakes up every `interval` seconds
+    and stats only folders, like `DirectoryScanner`. Files are stat-ed in changed folders only,
+    edits in place keep folder mtime and are found by stat of all files every `FULL_CHECK` seconds.
+    """
+    # Copying of many files or saving by editor comes as series of events
+    SETTLE = 0.3
+    FULL_CHECK = 60
+    _ANY = re.compile('')
+
+    def __init__(self, roots: List[Path], interval: float = 1.0):
+        self.roots = roots
+        self.interval = interval
+        self._events = queue.Queue()
+        self._observer = None
+        self._scanner = None
+        self._stamps = {}
+        self._checked = 0
+
+    @staticmethod
+    def ignored(path: Path):
+        # Metadata caches are written near the albums by the build itself
+        return path.name.startswith('.') or path.name.endswith('.cache.json')
+
+    @property
+    def backend(self):
+        return 'watchdog' if self._observer else 'polling'
+
+    def start(self):
+        if Observer is not None:
+            self._observer = Observer()
+            handler = _EventHandler(self._events)
+            for root in self.roots:
+                self._observer.schedule(handler, root.as_posix(), recursive=True)
+            self._observer.start()
+        else:
+            self._scanner = DirectoryScanner(None, ['.*', '*.cache.json'])
+            self._scanner.scan(self.roots)
+            self._stamps = self._stat(self._scanner.search(self._ANY))
+            self._checked = time.monotonic()
+
+    def wait(self):
+        """
+        Block until the next batch of changes, return changed paths. Polling returns after every interval,
+        the set can be empty.
+        """
+        if self._observer is None:
+            time.sleep(self.interval)
+            return self._poll()
+        paths = {self._events.get()}
+        while True:
+            try:
+                paths.add(self._events.get(timeout=self.SETTLE))
+            except queue.Empty:
+                return paths
+
+    def _poll(self):
+        folders = self._scanner.rescan(self.roots)
+        if time.monotonic() - self._checked >= self.FULL_CHECK:
+            stamps = self._stat(self._scanner.search(self._ANY))
+            compared = stamps.keys() | self._stamps.keys()
+            self._checked = time.monotonic()
+        else:
+            stamps = dict(self._stamps)
+            compared = set(i.as_posix() for i in folders)
+            for folder in compared:
+                stamps.pop(folder, None)
+            stamps.update(self._stat([j for i in folders for j in self._scanner.glob(i, '*') or []]))
+        paths = set()
+        for folder in compared:
+            before, after = self._stamps.get(folder, {}), stamps.get(folder, {})
+            paths.update(Path(i) for i in before.keys() | after.keys() if before.get(i) != after.get(i))
+        self._stamps = stamps
+        return paths
+
+    def _stat(self, paths: List[Path]):
+        """
+        Mtime and size of files by folder
+        """
+        stamps = {}
+        for path in paths:
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            stamps.setdefault(path.parent.as_posix(), {})[path.as_posix()] = (stat.st_mtime_ns, stat.st_size)
+        return stamps
+
+    def close(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Memory used by model objects of a large gallery.
+
+    cd src && python -m benchmarks.model_memory --count 100000
+"""
+import gc
+import hashlib
+import tracemalloc
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import click
+
+from behappy.core.conf import settings
+from behappy.core.model import Image
+
+
+def _source(album, i):
+    path = Path('/home/user/Pictures/Album {:04d}'.format(album), 'DSCF{:06d}.JPG'.format(i))
+    return {
+        'path': path.as_posix(),
+        'date': (datetime(2020, 1, 1) + timedelta(seconds=i)).isoformat(),
+        'orientation': 0,
+        'exif_info': 'Fujifilm X-T30  XF35mmF2 R WR | ISO320  f/2.0  1/420s | Astia | DSCF{:06d}'.format(i),
+        'stamp': hashlib.blake2b(b'stamp%d' % i, digest_size=32).hexdigest(),
+        'hash': hashlib.blake2b(b'hash%d' % i).hexdigest(),
+    }
+
+
+@click.command()
+@click.option('--count', default=100000, type=int, help='Images count')
+@click.option('--album-size', default=500, type=int, help='Images per album')
+@click.option('--conf', default=Path(__file__).parent.parent / 'samples' / 'behappy.gallery.ini',
+              help='Config with image sizes')
+def main(count, album_size, conf):
+    settings.load(conf)
+    sources = [_source(i // album_size, i) for i in range(count)]
+
+    gc.collect()
+    tracemalloc.start()
+    images = [Image.deserialize(i) for i in sources]
+    loaded, _ = tracemalloc.get_traced_memory()
+    for image in images:
+        for option in settings.image_variants():
+            image.rendition(option.key)
+    rendered, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print('{} images'.format(len(images)))
+    print('{:.0f} bytes per image loaded'.format(loaded / count))
+    print('{:.0f} bytes per image with renditions'.format(rendered / count))
+
+
+if __name__ == '__main__':
+    main()